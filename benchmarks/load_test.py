@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+
+def main():
+    """Sends POST /predict at increasing concurrency to a running serve.py.
+
+    Each client keeps one connection and sends its next request as soon as the
+    previous one is answered, so the concurrency is the number of requests in
+    flight for the micro-batcher to collect.
+
+    Requests are sent with the standard library only. cv2 and numpy are needed
+    just to synthesize the image when --image is not given.
+    """
+    args = get_args()
+    image = load_image(args)
+
+    results = []
+    for concurrency in args.concurrency:
+        if args.warmup > 0:
+            asyncio.run(run_level(args, image, concurrency, args.warmup))
+        result = asyncio.run(run_level(args, image, concurrency, args.requests))
+        result["server"] = asyncio.run(get_metrics(args))
+        results.append(result)
+
+    print(
+        f"{'clients':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+        f"{'errors':>6} {'batch':>6}"
+    )
+    for r in results:
+        print(
+            f"{r['concurrency']:>7} {r['requests_per_sec']:8.1f} "
+            f"{r['latency_p50_ms']:8.1f} {r['latency_p95_ms']:8.1f} "
+            f"{r['latency_p99_ms']:8.1f} {r['n_errors']:>6} "
+            f"{r['server'].get('mean_batch_size', 0.0):6.1f}"
+        )
+
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+        print(f"Saved: {args.out}")
+
+
+def load_image(args):
+    if args.image:
+        with open(args.image, "rb") as f:
+            return f.read()
+
+    import cv2
+    import numpy as np
+
+    # Smooth noise compresses more like a photo than white noise.
+    rng = np.random.default_rng(args.seed)
+    h, w = args.image_hw
+    image = rng.integers(0, 255, (h // 8, w // 8, 3), dtype=np.uint8)
+    image = cv2.resize(image, (w, h), interpolation=cv2.INTER_CUBIC)
+    return cv2.imencode(".jpg", image)[1].tobytes()
+
+
+async def run_level(args, image, concurrency, n_requests):
+    remaining = [n_requests]
+    latencies = []
+    n_errors = [0]
+
+    async def client():
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+        try:
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                start = time.perf_counter()
+                status, _ = await request(reader, writer, "POST", "/predict", image)
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    n_errors[0] += 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency * 1000.0 for latency in latencies]
+    return {
+        "concurrency": concurrency,
+        "n_requests": n_requests,
+        "n_errors": n_errors[0],
+        "requests_per_sec": n_requests / elapsed,
+        "latency_p50_ms": percentile(latencies, 50),
+        "latency_p95_ms": percentile(latencies, 95),
+        "latency_p99_ms": percentile(latencies, 99),
+    }
+
+
+def percentile(values, q):
+    """Same as the default linear interpolation of np.percentile."""
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+async def get_metrics(args):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    try:
+        _, body = await request(reader, writer, "GET", "/metrics")
+    finally:
+        writer.close()
+    return json.loads(body)
+
+
+async def request(reader, writer, method, path, body=b""):
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\n"
+        f"Host: localhost\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+
+    head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+    lines = head.split("\r\n")
+    status = int(lines[0].split(" ")[1])
+    length = 0
+    for line in lines[1:]:
+        if line.lower().startswith("content-length:"):
+            length = int(line.split(":", 1)[1])
+    return status, await reader.readexactly(length)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="""
+    Load test the micro-batching inference server of serve.py.
+    """
+    )
+
+    parser.add_argument("--host", default="127.0.0.1", help="Server host")
+    parser.add_argument("--port", type=int, default=8000, help="Server port")
+    parser.add_argument("--out", help="Result JSON")
+    parser.add_argument("--image", help="JPEG to send (default: synthetic)")
+    parser.add_argument(
+        "--image-hw", type=int, nargs=2, default=[720, 960], help="Synthetic size"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[1, 4, 16, 64],
+        help="Clients in flight",
+    )
+    parser.add_argument("--requests", type=int, default=200, help="Per concurrency")
+    parser.add_argument("--warmup", type=int, default=10, help="Warmup requests")
+    parser.add_argument("--seed", type=int, default=0, help="Seed")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from run import load_train, make_config, make_synthetic_data  # noqa: E402
+from src.make_dataset import make_dataloader, make_dataset  # noqa: E402
+
+
+def main():
+    """Samples the memory of each DataLoader worker over a few epochs.
+
+    USS (private pages) of a worker grows when it writes to pages shared with
+    the parent, e.g. refcounts of Python objects in the dataset. It should stay
+    flat after the first batches.
+    """
+    args = get_args()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="petfinder-bench-")
+    make_synthetic_data(args, work_dir)
+
+    c = make_config(
+        args,
+        work_dir,
+        [
+            f"settings.dataloader.num_workers={args.num_workers}",
+            "settings.dataloader.persistent_workers=True",
+        ],
+    )
+    ds = make_dataset(c, load_train(c, work_dir), "train")
+    loader = make_dataloader(c, ds, shuffle=True, drop_last=True)
+    sample_every = max(1, len(loader) // args.samples)
+
+    records = []
+    for epoch in range(args.epochs):
+        for step, _ in enumerate(loader):
+            if step % sample_every == 0 or step == len(loader) - 1:
+                for n, pid in enumerate(worker_pids()):
+                    records.append(
+                        {"epoch": epoch, "step": step, "worker": n, **memory(pid)}
+                    )
+
+    print(f"{'epoch':>5} {'step':>5} {'worker':>6} {'rss MB':>8} {'uss MB':>8}")
+    for r in records:
+        print(
+            f"{r['epoch']:>5} {r['step']:>5} {r['worker']:>6} "
+            f"{r['rss_mb']:8.1f} {r['uss_mb']:8.1f}"
+        )
+
+    print("USS growth from the first sample:")
+    for n in sorted({r["worker"] for r in records}):
+        uss = [r["uss_mb"] for r in records if r["worker"] == n]
+        print(f"worker {n}: {uss[-1] - uss[0]:+.1f} MB (max {np.max(uss):.1f} MB)")
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(records, f, indent=2)
+        print(f"Saved: {args.out}")
+
+
+def worker_pids():
+    """Child processes of this process, i.e. the DataLoader workers."""
+    pids = []
+    for tid in os.listdir(f"/proc/{os.getpid()}/task"):
+        with open(f"/proc/{os.getpid()}/task/{tid}/children") as f:
+            pids += [int(pid) for pid in f.read().split()]
+    return sorted(pids)
+
+
+def memory(pid):
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                values[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    return {
+        "rss_mb": values["Rss"],
+        "pss_mb": values["Pss"],
+        "uss_mb": values["Private_Clean"] + values["Private_Dirty"],
+    }
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="""
+    Report per-worker memory of the train DataLoader over epochs.
+    """
+    )
+
+    parser.add_argument("--out", help="Result JSON")
+    parser.add_argument("--work-dir", help="Synthetic data dir (default: temp dir)")
+    parser.add_argument("--n-images", type=int, default=1024, help="Synthetic images")
+    parser.add_argument(
+        "--image-hw", type=int, nargs=2, default=[240, 320], help="Source image size"
+    )
+    parser.add_argument("--model", default="resnet10t", help="timm model")
+    parser.add_argument("--size", type=int, default=128, help="Input size")
+    parser.add_argument("--batch-size", type=int, default=16, help="Batch size")
+    parser.add_argument("--num-workers", type=int, default=2, help="Workers")
+    parser.add_argument("--epochs", type=int, default=3, help="Epochs")
+    parser.add_argument("--samples", type=int, default=4, help="Samples per epoch")
+    parser.add_argument("--device", default="cpu", help="Device")
+    parser.add_argument("--seed", type=int, default=0, help="Seed")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
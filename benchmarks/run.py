@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import pandas as pd
+import torch
+from torch.cuda import amp
+from hydra import compose, initialize_config_dir
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from src.make_augment import BatchAugment  # noqa: E402
+from src.make_dataset import (  # noqa: E402
+    get_transforms,
+    make_dataloader,
+    make_dataset,
+)
+from src.make_fold import make_fold  # noqa: E402
+from src.make_loss import make_criterion, make_optimizer, make_scheduler  # noqa: E402
+from src.make_model import BaseModel  # noqa: E402
+from src.train_epoch import train_epoch, validate_epoch  # noqa: E402
+from src.utils import autocast, peak_memory_mb, sync  # noqa: E402
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+FEATURES = [
+    "Subject Focus",
+    "Eyes",
+    "Face",
+    "Near",
+    "Action",
+    "Accessory",
+    "Group",
+    "Collage",
+    "Human",
+    "Occlusion",
+    "Info",
+    "Blur",
+]
+
+
+def main():
+    args = get_args()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="petfinder-bench-")
+    make_synthetic_data(args, work_dir)
+
+    stages = args.stages.split(",") if args.stages else list(STAGES)
+    results = {}
+    for name in stages:
+        result = run_stage(name, args, work_dir)
+        results[name] = result
+        line = (
+            f"{name:<30} {result['images_per_sec']:10.1f} images/s "
+            f"{result['peak_rss_mb']:8.0f} MB"
+        )
+        if "peak_cuda_mb" in result:
+            line += f" {result['peak_cuda_mb']:8.0f} MB cuda"
+        print(line)
+
+    report = {
+        "meta": {
+            "host": platform.node(),
+            "torch": torch.__version__,
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved: {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(baseline["results"], results, args.threshold):
+            sys.exit(1)
+
+
+# ====================================================
+# Synthetic data in the train.csv schema
+# ====================================================
+def make_synthetic_data(args, work_dir):
+    image_dir = os.path.join(work_dir, "train")
+    if os.path.exists(os.path.join(work_dir, "train.csv")):
+        return
+    os.makedirs(image_dir, exist_ok=True)
+
+    rng = np.random.default_rng(args.seed)
+    ids = [f"{n:032x}" for n in range(args.n_images)]
+    df = pd.DataFrame({"Id": ids})
+    for col in FEATURES:
+        df[col] = rng.integers(0, 2, len(df))
+    df["Pawpularity"] = rng.integers(1, 101, len(df))
+
+    h, w = args.image_hw
+    for id_ in ids:
+        # Smooth noise compresses more like a photo than white noise.
+        image = rng.integers(0, 255, (h // 8, w // 8, 3), dtype=np.uint8)
+        image = cv2.resize(image, (w, h), interpolation=cv2.INTER_CUBIC)
+        cv2.imwrite(os.path.join(image_dir, f"{id_}.jpg"), image)
+
+    df.to_csv(os.path.join(work_dir, "train.csv"), index=False)
+
+
+def make_config(args, work_dir, overrides=()):
+    config_dir = os.path.join(ROOT, "config")
+    defaults = [
+        f"settings.dirs.working={ROOT}",
+        f"settings.dirs.input={work_dir}/",
+        f"settings.dirs.cache={work_dir}/cache/",
+        f"wandb.dir={work_dir}",
+        "mlflow.enabled=False",
+        "wandb.enabled=False",
+        "settings.multi_gpu=False",
+        "settings.print_freq=1000000",
+        f"settings.amp={args.device.startswith('cuda')}",
+        f"params.model_name={args.model}",
+        f"params.size={args.size}",
+        f"params.batch_size={args.batch_size}",
+        "params.gradient_acc_step=1",
+        "params.n_fold=5",
+        "params.epoch=1",
+    ]
+    # Hydra rejects a key overridden twice, so overrides replace the defaults.
+    keys = {o.split("=", 1)[0] for o in overrides}
+    defaults = [o for o in defaults if o.split("=", 1)[0] not in keys]
+    with initialize_config_dir(config_dir=config_dir, version_base=None):
+        c = compose(config_name="main", overrides=[*defaults, *overrides])
+    return c
+
+
+def load_train(c, work_dir):
+    df = pd.read_csv(os.path.join(work_dir, "train.csv"))
+    return make_fold(c, df)
+
+
+# ====================================================
+# Stages
+# Each returns (number of images, elapsed seconds).
+# ====================================================
+def bench_dataset(args, work_dir):
+    c = make_config(args, work_dir)
+    ds = make_dataset(c, load_train(c, work_dir), "train")
+
+    start = time.perf_counter()
+    for idx in range(len(ds)):
+        ds[idx]
+    return len(ds), time.perf_counter() - start
+
+
+def bench_dataloader(args, work_dir, num_workers):
+    c = make_config(args, work_dir, [f"settings.dataloader.num_workers={num_workers}"])
+    ds = make_dataset(c, load_train(c, work_dir), "train")
+    loader = make_dataloader(c, ds, shuffle=True, drop_last=True)
+
+    n = 0
+    start = time.perf_counter()
+    for images, _, _ in loader:
+        n += len(images)
+    return n, time.perf_counter() - start
+
+
+def bench_make_dataloader(args, work_dir):
+    c = make_config(args, work_dir)
+    ds = make_dataset(c, load_train(c, work_dir), "train")
+    loader = make_dataloader(c, ds, shuffle=True, drop_last=True)
+
+    n = 0
+    start = time.perf_counter()
+    for images, _, _ in loader:
+        n += len(images)
+    return n, time.perf_counter() - start
+
+
+def bench_forward(args, work_dir, overrides=()):
+    c = make_config(args, work_dir, overrides)
+    device = torch.device(args.device)
+    model = BaseModel(c, pretrained=False).to(device).eval()
+    images = torch.randn(args.batch_size, 3, args.size, args.size, device=device)
+    features = torch.zeros(args.batch_size, len(FEATURES), device=device)
+
+    with torch.inference_mode():
+        model(images, features)
+        sync(device)
+        start = time.perf_counter()
+        for _ in range(args.iters):
+            model(images, features)
+        sync(device)
+    return args.batch_size * args.iters, time.perf_counter() - start
+
+
+def bench_train_step(args, work_dir, overrides=()):
+    c = make_config(args, work_dir, overrides)
+    device = torch.device(args.device)
+    model = BaseModel(c, pretrained=False).to(device)
+    criterion = make_criterion(c)
+    optimizer = make_optimizer(c, model)
+    images = torch.randn(args.batch_size, 3, args.size, args.size, device=device)
+    features = torch.zeros(args.batch_size, len(FEATURES), device=device)
+    labels = torch.rand(args.batch_size, device=device)
+
+    def step():
+        with autocast(device.type, c.settings.amp, c.settings.execution.cpu_dtype):
+            loss = criterion(model(images, features).view(-1), labels)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+    # The first steps include the compilation of torch.compile.
+    for _ in range(2):
+        step()
+    sync(device)
+    start = time.perf_counter()
+    for _ in range(args.iters):
+        step()
+    sync(device)
+    return args.batch_size * args.iters, time.perf_counter() - start
+
+
+def bench_train_epoch(args, work_dir):
+    c = make_config(args, work_dir)
+    device = torch.device(args.device)
+    train = load_train(c, work_dir)
+    ds = make_dataset(c, train[train["fold"] != 0].reset_index(drop=True), "train")
+    loader = make_dataloader(c, ds, shuffle=True, drop_last=True)
+
+    model = BaseModel(c, pretrained=False).to(device)
+    criterion = make_criterion(c)
+    optimizer = make_optimizer(c, model)
+    scheduler = make_scheduler(c, optimizer, ds)
+    scaler = amp.GradScaler(enabled=c.settings.amp and device.type == "cuda")
+
+    start = time.perf_counter()
+    train_epoch(c, loader, model, criterion, optimizer, scheduler, scaler, 0, device)
+    sync(device)
+    return len(loader) * c.params.batch_size, time.perf_counter() - start
+
+
+def bench_validate_epoch(args, work_dir):
+    c = make_config(args, work_dir)
+    device = torch.device(args.device)
+    train = load_train(c, work_dir)
+    ds = make_dataset(c, train[train["fold"] == 0].reset_index(drop=True), "valid")
+    loader = make_dataloader(c, ds, shuffle=False, drop_last=False)
+
+    model = BaseModel(c, pretrained=False).to(device)
+    criterion = make_criterion(c)
+
+    start = time.perf_counter()
+    validate_epoch(c, loader, model, criterion, device)
+    return len(ds), time.perf_counter() - start
+
+
+def bench_augment_per_sample(args, work_dir):
+    c = make_config(args, work_dir)
+    transform = get_transforms(c, "train")
+    images = random_images(args)
+
+    start = time.perf_counter()
+    for _ in range(args.iters):
+        torch.stack([transform(image=image)["image"] for image in images])
+    return len(images) * args.iters, time.perf_counter() - start
+
+
+def bench_augment_batched(args, work_dir):
+    c = make_config(args, work_dir)
+    device = torch.device(args.device)
+    batch_augment = BatchAugment(c).to(device)
+    images = torch.from_numpy(random_images(args)).permute(0, 3, 1, 2).to(device)
+
+    batch_augment(images)
+    sync(device)
+    start = time.perf_counter()
+    for _ in range(args.iters):
+        batch_augment(images)
+    sync(device)
+    return len(images) * args.iters, time.perf_counter() - start
+
+
+STAGES = {
+    "dataset_getitem": bench_dataset,
+    "dataloader_w0": lambda args, work_dir: bench_dataloader(args, work_dir, 0),
+    "dataloader_w2": lambda args, work_dir: bench_dataloader(args, work_dir, 2),
+    "dataloader_w4": lambda args, work_dir: bench_dataloader(args, work_dir, 4),
+    "make_dataloader": bench_make_dataloader,
+    "model_forward": bench_forward,
+    "model_forward_channels_last": lambda args, work_dir: bench_forward(
+        args, work_dir, ["settings.execution.channels_last=True"]
+    ),
+    "model_forward_amp": lambda args, work_dir: bench_forward(
+        args, work_dir, ["settings.amp=True"]
+    ),
+    "model_forward_compile": lambda args, work_dir: bench_forward(
+        args, work_dir, ["settings.execution.compile=True"]
+    ),
+    "train_step": bench_train_step,
+    "train_step_channels_last": lambda args, work_dir: bench_train_step(
+        args, work_dir, ["settings.execution.channels_last=True"]
+    ),
+    "train_step_amp": lambda args, work_dir: bench_train_step(
+        args, work_dir, ["settings.amp=True"]
+    ),
+    "train_step_compile": lambda args, work_dir: bench_train_step(
+        args, work_dir, ["settings.execution.compile=True"]
+    ),
+    "train_step_grad_checkpointing": lambda args, work_dir: bench_train_step(
+        args, work_dir, ["settings.execution.grad_checkpointing=True"]
+    ),
+    "train_epoch": bench_train_epoch,
+    "validate_epoch": bench_validate_epoch,
+    "augment_per_sample": bench_augment_per_sample,
+    "augment_batched": bench_augment_batched,
+}
+
+
+def random_images(args):
+    rng = np.random.default_rng(args.seed)
+    return rng.integers(
+        0, 255, (args.batch_size, args.size, args.size, 3), dtype=np.uint8
+    )
+
+
+# ====================================================
+# Runner
+# ====================================================
+def run_stage(name, args, work_dir):
+    """Runs a stage in a fresh process, so that peak RSS is per stage."""
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    p = ctx.Process(target=_stage_worker, args=(name, args, work_dir, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    if "error" in result:
+        raise Exception(f"Stage {name} failed: {result['error']}")
+    return result
+
+
+def _stage_worker(name, args, work_dir, queue):
+    try:
+        # A spawned process inherits "spawn" as its start method, but train.py
+        # forks its DataLoader workers, so go back to the platform default.
+        multiprocessing.set_start_method(None, force=True)
+        torch.set_num_threads(args.threads)
+        n, elapsed = STAGES[name](args, work_dir)
+        # ru_maxrss is in KB on Linux. Children are the DataLoader workers.
+        rss_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        result = {
+            "images": n,
+            "elapsed": elapsed,
+            "images_per_sec": n / elapsed,
+            "peak_rss_mb": rss_self,
+            "peak_rss_children_mb": rss_children,
+        }
+        device = torch.device(args.device)
+        if device.type == "cuda":
+            result["peak_cuda_mb"] = peak_memory_mb(device)
+        queue.put(result)
+    except Exception as e:
+        queue.put({"error": repr(e)})
+
+
+def compare(baseline, results, threshold):
+    """Prints the change against baseline, returns True on any regression."""
+    regressed = False
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        speed = result["images_per_sec"] / base["images_per_sec"] - 1.0
+        memory = result["peak_rss_mb"] / base["peak_rss_mb"] - 1.0
+        flag = ""
+        if speed < -threshold or memory > threshold:
+            flag = "REGRESSION"
+            regressed = True
+        print(
+            f"{name:<24} speed: {speed * 100:+6.1f}% rss: {memory * 100:+6.1f}% {flag}"
+        )
+    return regressed
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="""
+    Benchmark the data, model and training hot paths on synthetic data.
+    """
+    )
+
+    parser.add_argument("--out", default="benchmark.json", help="Result JSON")
+    parser.add_argument("--baseline", help="Baseline JSON to compare with")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1, help="Allowed regression ratio"
+    )
+    parser.add_argument("--stages", help="Comma separated stages (default: all)")
+    parser.add_argument("--work-dir", help="Synthetic data dir (default: temp dir)")
+    parser.add_argument("--n-images", type=int, default=256, help="Synthetic images")
+    parser.add_argument(
+        "--image-hw", type=int, nargs=2, default=[480, 640], help="Source image size"
+    )
+    parser.add_argument("--model", default="resnet10t", help="timm model")
+    parser.add_argument("--size", type=int, default=128, help="Input size")
+    parser.add_argument("--batch-size", type=int, default=16, help="Batch size")
+    parser.add_argument("--iters", type=int, default=10, help="Iterations")
+    parser.add_argument("--threads", type=int, default=1, help="torch threads")
+    parser.add_argument("--device", default="cpu", help="Device")
+    parser.add_argument("--seed", type=int, default=0, help="Seed")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
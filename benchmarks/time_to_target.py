@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.cuda import amp
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from run import load_train, make_config, make_synthetic_data  # noqa: E402
+from src.get_score import get_score  # noqa: E402
+from src.make_dataset import make_dataloader, make_dataset  # noqa: E402
+from src.make_loss import make_criterion, make_optimizer, make_scheduler  # noqa: E402
+from src.make_model import BaseModel  # noqa: E402
+from src.train_epoch import train_epoch, validate_epoch  # noqa: E402
+from src.utils import seed_torch, sync  # noqa: E402
+
+
+def main():
+    """Trains fold 0 at the fixed size and with progressive resizing, and
+    reports the train time each takes to reach the target RMSE.
+
+    The target defaults to the best RMSE of the fixed-size run. Validation runs
+    at the full size for both, so only the train time is counted.
+
+    Labels of the synthetic data are random, so pass the competition data as
+    --work-dir for meaningful RMSEs.
+    """
+    args = get_args()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="petfinder-bench-")
+    make_synthetic_data(args, work_dir)
+
+    progressive = [
+        "params.progressive_resize.enabled=True",
+        f"params.progressive_resize.min_size={args.min_size}",
+        f"params.progressive_resize.ramp_epochs={args.ramp_epochs}",
+        f"params.progressive_resize.granularity={args.granularity}",
+    ]
+    runs = {
+        "fixed": train(args, work_dir, []),
+        "progressive": train(args, work_dir, progressive),
+    }
+
+    target = args.target or min(r["score"] for r in runs["fixed"])
+    print(f"Target RMSE: {target:.4f}")
+    print(f"{'run':<12} {'epoch':>5} {'train s':>8} {'best RMSE':>9}")
+    results = {}
+    for name, history in runs.items():
+        reached = [r for r in history if r["score"] <= target]
+        results[name] = {
+            "history": history,
+            "best_score": min(r["score"] for r in history),
+            "epoch_to_target": reached[0]["epoch"] if reached else None,
+            "sec_to_target": reached[0]["train_sec"] if reached else None,
+        }
+        r = results[name]
+        print(
+            f"{name:<12} {r['epoch_to_target'] or '-':>5} "
+            f"{r['sec_to_target'] or float('nan'):8.1f} {r['best_score']:9.4f}"
+        )
+
+    if results["fixed"]["sec_to_target"] and results["progressive"]["sec_to_target"]:
+        speedup = (
+            results["fixed"]["sec_to_target"] / results["progressive"]["sec_to_target"]
+        )
+        print(f"Speedup to target: x{speedup:.2f}")
+
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(
+                {"args": vars(args), "target": target, "results": results}, f, indent=2
+            )
+        print(f"Saved: {args.out}")
+
+
+def train(args, work_dir, overrides):
+    c = make_config(
+        args,
+        work_dir,
+        [f"params.epoch={args.epochs}", f"params.lr={args.lr}", *overrides],
+    )
+    device = torch.device(args.device)
+    seed_torch(args.seed)
+
+    df = load_train(c, work_dir)
+    train_folds = df[df["fold"] != 0].reset_index(drop=True)
+    valid_folds = df[df["fold"] == 0].reset_index(drop=True)
+    train_loader = make_dataloader(
+        c, make_dataset(c, train_folds, "train"), shuffle=True, drop_last=True
+    )
+    valid_loader = make_dataloader(
+        c, make_dataset(c, valid_folds, "valid"), shuffle=False, drop_last=False
+    )
+
+    model = BaseModel(c, pretrained=args.pretrained).to(device)
+    criterion = make_criterion(c)
+    optimizer = make_optimizer(c, model)
+    scheduler = make_scheduler(c, optimizer, train_folds)
+    scaler = amp.GradScaler(enabled=c.settings.amp and device.type == "cuda")
+
+    history = []
+    train_sec = 0.0
+    for epoch in range(c.params.epoch):
+        start = time.perf_counter()
+        train_epoch(
+            c,
+            train_loader,
+            model,
+            criterion,
+            optimizer,
+            scheduler,
+            scaler,
+            epoch,
+            device,
+        )
+        sync(device)
+        train_sec += time.perf_counter() - start
+
+        _, preds = validate_epoch(c, valid_loader, model, criterion, device)
+        if "WithLogitsLoss" in c.params.criterion:
+            preds = 1 / (1 + np.exp(-preds))
+        score = get_score(valid_folds["Pawpularity"].values, preds * 100.0)
+        history.append({"epoch": epoch + 1, "train_sec": train_sec, "score": score})
+    return history
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="""
+    Compare the train time to a target RMSE with and without progressive resizing.
+    """
+    )
+
+    parser.add_argument("--out", help="Result JSON")
+    parser.add_argument("--work-dir", help="Data dir (default: synthetic in temp dir)")
+    parser.add_argument("--n-images", type=int, default=512, help="Synthetic images")
+    parser.add_argument(
+        "--image-hw", type=int, nargs=2, default=[240, 320], help="Source image size"
+    )
+    parser.add_argument("--model", default="resnet10t", help="timm model")
+    parser.add_argument("--pretrained", action="store_true", help="Pretrained weights")
+    parser.add_argument("--size", type=int, default=128, help="Full input size")
+    parser.add_argument("--min-size", type=int, default=64, help="First epoch size")
+    parser.add_argument("--ramp-epochs", type=int, default=3, help="Ramp epochs")
+    parser.add_argument(
+        "--granularity", default="epoch", choices=["epoch", "step"], help="Ramp unit"
+    )
+    parser.add_argument("--epochs", type=int, default=5, help="Epochs")
+    parser.add_argument("--lr", type=float, default=1e-4, help="Learning rate")
+    parser.add_argument("--batch-size", type=int, default=16, help="Batch size")
+    parser.add_argument("--target", type=float, help="Target RMSE")
+    parser.add_argument("--device", default="cpu", help="Device")
+    parser.add_argument("--seed", type=int, default=0, help="Seed")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
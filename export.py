@@ -0,0 +1,81 @@
+import logging
+import os
+
+import hydra
+import pandas as pd
+import torch
+
+import src.utils as utils
+from src.export_model import export_fold_models
+from src.load_data import load_data
+from src.make_fold import make_fold
+from src.make_model import BaseModel
+from src.predict import load_base_config
+from src.runtime import artifact_name, benchmark_runtime, load_runtime_model
+
+log = logging.getLogger(__name__)
+
+
+@hydra.main(config_path="config", config_name="main")
+def main(c):
+    log.info("Started.")
+
+    # Exported models run on CPU in fp32 or int8.
+    c.settings.amp = False
+    c.settings.execution.channels_last = False
+    c.settings.execution.compile = False
+    utils.backend_settings(c)
+    if c.inference.n_threads > 0:
+        torch.set_num_threads(c.inference.n_threads)
+
+    train, test, sub = load_data(c)
+
+    report = []
+    benchmark = []
+    for base in c.export.base_results:
+        base_dir = os.path.join(c.settings.dirs.working, "..", "base_results", base)
+        bc = load_base_config(c, base_dir)
+        # Same folds as the base result was trained with.
+        _train = make_fold(bc, train.copy())
+
+        log.info(f"========== {base} export ==========")
+        report += [
+            {"base": base, **r} for r in export_fold_models(bc, base_dir, _train)
+        ]
+
+        log.info(f"========== {base} benchmark ==========")
+        fold = report[-1]["fold"]
+        models = {"torch": BaseModel(bc, pretrained=False).eval()}
+        for fmt in c.export.formats:
+            path = os.path.join(base_dir, c.export.dir, artifact_name(bc, fold, fmt))
+            models[fmt] = load_runtime_model(bc, path)
+
+        for runtime, model in models.items():
+            for r in benchmark_runtime(
+                model, c.export.batch_sizes, bc.params.size, c.export.n_iter
+            ):
+                benchmark.append({"base": base, "runtime": runtime, **r})
+                log.info(
+                    f"{runtime} batch {r['batch_size']}: "
+                    f"p50 {r['latency_p50_ms']:.1f} ms "
+                    f"p90 {r['latency_p90_ms']:.1f} ms "
+                    f"{r['images_per_sec']:.1f} images/s"
+                )
+
+    report_df = pd.DataFrame(report)
+    report_df.to_csv("export_report.csv", index=False)
+    pd.DataFrame(benchmark).to_csv("export_benchmark.csv", index=False)
+    log.info(f"Export report:\n{report_df.to_string(index=False)}")
+
+    failed = report_df[~report_df["passed"]]
+    if len(failed) > 0:
+        raise Exception(
+            f"{len(failed)} exported models differ from fp32 by more than "
+            f"{c.export.tolerance}."
+        )
+
+    log.info("Done.")
+
+
+if __name__ == "__main__":
+    main()
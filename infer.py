@@ -0,0 +1,64 @@
+import logging
+import os
+import time
+
+import hydra
+import numpy as np
+import pandas as pd
+import torch
+
+import src.utils as utils
+from src.load_data import load_data
+from src.make_dataset import make_dataloader, make_dataset
+from src.predict import load_base_config, postprocess, predict, predict_folds
+from src.runtime import load_runtime_models
+
+log = logging.getLogger(__name__)
+
+
+@hydra.main(config_path="config", config_name="main")
+def main(c):
+    log.info("Started.")
+
+    device = utils.gpu_settings(c)
+    if c.inference.n_threads > 0:
+        torch.set_num_threads(c.inference.n_threads)
+    log.info(f"torch threads: {torch.get_num_threads()}")
+
+    train, test, sub = load_data(c)
+
+    preds = np.zeros((len(c.inference.base_results), len(test)), dtype=np.float32)
+    for n, base in enumerate(c.inference.base_results):
+        base_dir = os.path.join(c.settings.dirs.working, "..", "base_results", base)
+        bc = load_base_config(c, base_dir)
+        bc.params.batch_size = c.inference.batch_size
+        bc.params.tta = c.params.tta
+
+        test_ds = make_dataset(bc, test, "valid", label=False)
+        test_loader = make_dataloader(bc, test_ds, shuffle=False, drop_last=False)
+
+        start = time.time()
+        if c.inference.runtime == "torch":
+            # One model in memory, the folds' weights are loaded in turn.
+            fold_preds = predict_folds(bc, test_loader, base_dir, device)
+        else:
+            models = load_runtime_models(bc, base_dir)
+            fold_preds = predict(bc, test_loader, models, device)
+        elapsed = time.time() - start
+        log.info(
+            f"{base}: {len(fold_preds)} folds, "
+            f"{len(test) / elapsed:.1f} images/s "
+            f"({len(test) * len(fold_preds) / elapsed:.1f} forwards/s)"
+        )
+
+        preds[n] = postprocess(bc, fold_preds).mean(axis=0)
+
+    pawpularity = pd.Series(preds.mean(axis=0), index=test["Id"].values)
+    sub["Pawpularity"] = sub["Id"].map(pawpularity).values
+    sub.to_csv("submission.csv", index=False)
+
+    log.info("Done.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+import logging
+
+import hydra
+
+from src.make_image_cache import make_image_cache
+
+log = logging.getLogger(__name__)
+
+
+@hydra.main(config_path="config", config_name="main")
+def main(c):
+    log.info("Started.")
+
+    for image_dir in [c.settings.dirs.train_image, c.settings.dirs.test_image]:
+        make_image_cache(c, image_dir)
+
+    log.info("Done.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import asyncio
+import logging
+import os
+
+import hydra
+import torch
+
+import src.utils as utils
+from src.predict import load_base_config, load_fold_models
+from src.runtime import load_runtime_models
+from src.serve import Ensemble, serve
+
+log = logging.getLogger(__name__)
+
+
+@hydra.main(config_path="config", config_name="main")
+def main(c):
+    log.info("Started.")
+
+    device = utils.gpu_settings(c)
+    if c.inference.n_threads > 0:
+        torch.set_num_threads(c.inference.n_threads)
+    log.info(f"torch threads: {torch.get_num_threads()}")
+
+    configs, models = [], []
+    for base in c.inference.base_results:
+        base_dir = os.path.join(c.settings.dirs.working, "..", "base_results", base)
+        bc = load_base_config(c, base_dir)
+        bc.params.tta = c.params.tta
+
+        if c.inference.runtime == "torch":
+            models.append(load_fold_models(bc, base_dir, device))
+        else:
+            models.append(load_runtime_models(bc, base_dir))
+        configs.append(bc)
+        log.info(f"{base}: {len(models[-1])} folds")
+
+    asyncio.run(serve(c, Ensemble(configs, models, device)))
+
+
+if __name__ == "__main__":
+    main()
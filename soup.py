@@ -0,0 +1,108 @@
+import logging
+import os
+
+import hydra
+import pandas as pd
+import torch
+
+import src.utils as utils
+from src.load_data import load_data
+from src.make_fold import make_fold
+from src.make_model import BaseModel
+from src.make_soup import (
+    SoupScorer,
+    fold_predictions,
+    load_fold_states,
+    make_soup,
+    oof_predictions,
+    oof_scores,
+    soup_score,
+)
+from src.predict import load_base_config
+
+log = logging.getLogger(__name__)
+
+
+@hydra.main(config_path="config", config_name="main")
+def main(c):
+    log.info("Started.")
+
+    utils.seed_torch(c.params.seed)
+    device = utils.gpu_settings(c)
+
+    train, test, sub = load_data(c)
+
+    report = []
+    for base in c.soup.base_results:
+        base_dir = os.path.join(c.settings.dirs.working, "..", "base_results", base)
+        bc = load_base_config(c, base_dir)
+        bc.params.tta = c.params.tta
+        # Same folds as the base result was trained with.
+        _train = make_fold(bc, train.copy())
+        eval_df = _train
+        if c.soup.n_valid > 0 and len(eval_df) > c.soup.n_valid:
+            eval_df = eval_df.sample(n=c.soup.n_valid, random_state=c.params.seed)
+
+        log.info(f"========== {base} soup ==========")
+        states = load_fold_states(bc, base_dir)
+        model = BaseModel(bc, pretrained=False).to(device)
+        scorer = SoupScorer(bc, model, eval_df, _train, device)
+
+        # Every fold model has been trained on the rows of the other folds, so
+        # the fold ensemble is represented by its oof predictions.
+        preds = fold_predictions(states, scorer)
+        fold_scores = oof_scores(scorer, preds)
+        oof = oof_predictions(scorer, preds)
+        oof_score = scorer.score(oof, states)
+        log.info(f"oof: {oof_score:.5f}")
+
+        report.append(
+            {
+                "base": base,
+                "method": "ensemble",
+                "folds": " ".join(map(str, states)),
+                "n_forward": len(states),
+                "score": oof_score,
+                "oof_score": oof_score,
+                "optimistic": False,
+            }
+        )
+        for method in c.soup.methods:
+            soup, folds = make_soup(
+                states, method, fold_scores, c.soup.greedy_tolerance
+            )
+            score, soup_oof_score, optimistic = soup_score(
+                scorer.labels, scorer.folds, scorer.predict(soup), oof, folds
+            )
+            message = (
+                f"{method} soup of folds {folds}: {score:.5f} "
+                f"(oof on the same rows {soup_oof_score:.5f})"
+            )
+            if optimistic:
+                log.warning(f"{message} is optimistic, its folds saw these rows.")
+            else:
+                log.info(message)
+
+            # With the BatchNorm statistics re-estimated for the soup.
+            torch.save(scorer.model.state_dict(), f"{base}_soup_{method}.pth")
+            report.append(
+                {
+                    "base": base,
+                    "method": method,
+                    "folds": " ".join(map(str, folds)),
+                    "n_forward": 1,
+                    "score": score,
+                    "oof_score": soup_oof_score,
+                    "optimistic": optimistic,
+                }
+            )
+
+    report_df = pd.DataFrame(report)
+    report_df.to_csv("soup_report.csv", index=False)
+    log.info(f"Soup report:\n{report_df.to_string(index=False)}")
+
+    log.info("Done.")
+
+
+if __name__ == "__main__":
+    main()
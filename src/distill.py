@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+from .get_score import get_score
+from .make_ensemble import fit_weights, load_oof_matrix
+from .make_model import BaseModel
+from .predict import load_base_config
+from .runtime import benchmark_runtime
+
+log = logging.getLogger("__main__").getChild("distill")
+
+
+def add_teacher(c, df):
+    """Adds the soft targets of distillation to df, blends of the oof
+    predictions of c.distill.base_results.
+
+    teacher_<fold> is the target of the student of that fold. Its blending
+    weights are fit only on the teacher oof of the train rows of that student,
+    so the labels of its validation rows are never used. teacher is the blend
+    of each row by the weights of its own fold, the oof prediction of the
+    teacher. Rows missing from the base results keep their label as the target.
+    """
+    base_results = list(c.distill.base_results)
+    # The folds of the student, not of the base results.
+    teacher_df, x, _ = load_oof_matrix(c, df, base_results)
+    y = teacher_df["Pawpularity"].values.astype(np.float64)
+    folds = teacher_df["fold"].values
+
+    targets = {}
+    teacher = np.empty(len(y))
+    for fold in np.unique(df["fold"].values):
+        trn = folds != fold
+        w = fit_weights(c, x[trn], y[trn], c.distill.method)
+        targets[f"teacher_{fold}"] = x @ w
+        teacher[~trn] = x[~trn] @ w
+    targets["teacher"] = teacher
+    score = get_score(y, teacher)
+    log.info(f"Teacher {c.distill.method} of {len(base_results)} models: {score:.5f}")
+
+    missing = ~df["Id"].isin(teacher_df["Id"])
+    if missing.any():
+        log.warning(f"{missing.sum()} rows have no teacher, use their labels.")
+    for name, values in targets.items():
+        df[name] = df["Id"].map(dict(zip(teacher_df["Id"].values, values)))
+        df.loc[missing, name] = df.loc[missing, "Pawpularity"]
+        df[name] = df[name].astype(np.float64)
+    return df
+
+
+def select_teacher(df, fold=None):
+    """Returns df with the soft targets of the student of fold as its teacher
+    column, or without soft targets when fold is None."""
+    columns = [col for col in df.columns if col.startswith("teacher")]
+    selected = df.drop(columns, axis=1)
+    if fold is not None:
+        selected["teacher"] = df[f"teacher_{fold}"].values
+    return selected
+
+
+def report_distill(c, oof_df, device):
+    """Logs the RMSE gap of the student to the teacher on the oof rows, and the
+    inference speedup of the student folds over the teacher ensemble."""
+    labels = oof_df["Pawpularity"].values
+    student_score = get_score(labels, oof_df["preds"].values)
+    teacher_score = get_score(labels, oof_df["teacher"].values)
+
+    d = c.distill
+    student = images_per_sec(c, device)
+    # Seconds per image of every fold model of every base result.
+    teacher_time = 0.0
+    for base in d.base_results:
+        base_dir = os.path.join(c.settings.dirs.working, "..", "base_results", base)
+        bc = load_base_config(c, base_dir)
+        teacher_time += bc.params.n_fold / images_per_sec(bc, device)
+    student_time = c.params.n_fold / student
+
+    report = {
+        "student": c.params.model_name,
+        "student_size": c.params.size,
+        "student_score": student_score,
+        "teacher_score": teacher_score,
+        "gap": student_score - teacher_score,
+        "student_images_per_sec": 1.0 / student_time,
+        "teacher_images_per_sec": 1.0 / teacher_time,
+        "speedup": teacher_time / student_time,
+        "speedup_single_fold": teacher_time * student,
+    }
+    log.info(
+        f"Student {student_score:.5f} teacher {teacher_score:.5f} "
+        f"gap {report['gap']:+.5f}, "
+        f"speedup x{report['speedup']:.1f} "
+        f"(x{report['speedup_single_fold']:.1f} with a single fold)"
+    )
+    with open("distill_report.json", "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def images_per_sec(c, device):
+    model = BaseModel(c, pretrained=False).to(device).eval()
+    d = c.distill
+    result = benchmark_runtime(model, [d.batch_size], c.params.size, d.n_iter, device)
+    return result[0]["images_per_sec"]
@@ -0,0 +1,213 @@
+import copy
+import logging
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from .get_score import get_score
+from .make_dataset import make_dataloader, make_dataset
+from .make_model import BaseModel
+from .predict import checkpoint_path, load_state_dict, postprocess, predict
+from .runtime import artifact_name, load_runtime_model
+
+log = logging.getLogger("__main__").getChild("export_model")
+
+
+class ExportModel(nn.Module):
+    """BaseModel without the unused features input, autocast and memory format,
+    so it can be traced and quantized."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model.model
+        self.head = model.head if hasattr(model, "head") else None
+
+    def forward(self, x):
+        x = self.model(x)
+        if self.head is not None:
+            x = self.head(x)
+        return x
+
+
+def export_fold_models(c, base_dir, train):
+    """Exports the best checkpoint of every fold on CPU, and validates the
+    exported models against the fp32 models on the oof rows of their fold.
+
+    train must have the folds of the base result. Returns a report row per fold.
+    """
+    device = torch.device("cpu")
+    export_dir = os.path.join(base_dir, c.export.dir)
+    os.makedirs(export_dir, exist_ok=True)
+
+    base_model = BaseModel(c, pretrained=False)
+
+    report = []
+    for fold in range(c.params.n_fold):
+        path = checkpoint_path(c, base_dir, fold)
+        if not os.path.exists(path):
+            log.warning(f"Checkpoint is not found: {path}")
+            continue
+        model = copy.deepcopy(base_model)
+        model.load_state_dict(load_state_dict(path))
+        model.to(device).eval()
+
+        calib_df = train[train["fold"] != fold].sample(
+            n=min(c.export.n_calibration, (train["fold"] != fold).sum()),
+            random_state=c.params.seed,
+        )
+        calib_loader = make_loader(c, calib_df)
+        example = next(iter(calib_loader))[0][:1]
+        export_model = ExportModel(model).eval()
+
+        for fmt in c.export.formats:
+            path = os.path.join(export_dir, artifact_name(c, fold, fmt))
+            if fmt == "torchscript":
+                export_torchscript(c, export_model, example, calib_loader, path)
+            elif fmt == "onnx":
+                export_onnx(c, export_model, example, calib_loader, path)
+
+            else:
+                raise Exception("Invalid export format.")
+            log.info(f"Exported: {path}")
+
+            valid_df = train[train["fold"] == fold]
+            if c.export.n_valid > 0 and len(valid_df) > c.export.n_valid:
+                valid_df = valid_df.sample(
+                    n=c.export.n_valid, random_state=c.params.seed
+                )
+            report.append(
+                {
+                    "fold": fold,
+                    "format": fmt,
+                    "quantize": c.export.quantize,
+                    "size_mb": os.path.getsize(path) / 2**20,
+                    **validate_export(c, model, load_runtime_model(c, path), valid_df),
+                }
+            )
+            r = report[-1]
+            log.info(
+                f"fold {fold} {fmt}: max diff {r['max_diff']:.4f} "
+                f"score {r['score']:.5f} (fp32 {r['fp32_score']:.5f})"
+            )
+
+    if len(report) == 0:
+        raise Exception(f"No checkpoint found in {base_dir}.")
+    return report
+
+
+def make_loader(c, df):
+    ds = make_dataset(c, df.reset_index(drop=True), "valid")
+    return make_dataloader(c, ds, shuffle=False, drop_last=False)
+
+
+# ====================================================
+# TorchScript
+# ====================================================
+def export_torchscript(c, model, example, calib_loader, path):
+    model = quantize_torch(c, model, example, calib_loader)
+    with torch.no_grad():
+        module = torch.jit.trace(model, example)
+    module = torch.jit.freeze(module)
+    torch.jit.save(module, path)
+
+
+def quantize_torch(c, model, example, calib_loader):
+    """Post-training int8 quantization of the weights (dynamic) or of the
+    weights and activations calibrated on calib_loader (static)."""
+    if c.export.quantize == "none":
+        return model
+    elif c.export.quantize == "dynamic":
+        return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    elif c.export.quantize == "static":
+        torch.backends.quantized.engine = c.export.backend
+        qconfig_mapping = get_default_qconfig_mapping(c.export.backend)
+        model = prepare_fx(model, qconfig_mapping, (example,))
+        with torch.inference_mode():
+            for batch in calib_loader:
+                model(batch[0])
+        return convert_fx(model)
+
+    else:
+        raise Exception("Invalid quantization.")
+
+
+# ====================================================
+# ONNX
+# ====================================================
+def export_onnx(c, model, example, calib_loader, path):
+    fp32_path = path if c.export.quantize == "none" else f"{path}.fp32.tmp"
+    torch.onnx.export(
+        model,
+        (example,),
+        fp32_path,
+        input_names=["images"],
+        output_names=["preds"],
+        dynamic_axes={"images": {0: "batch"}, "preds": {0: "batch"}},
+        opset_version=c.export.opset,
+        dynamo=False,
+    )
+    if c.export.quantize != "none":
+        quantize_onnx(c, fp32_path, path, calib_loader)
+        os.remove(fp32_path)
+
+
+def quantize_onnx(c, fp32_path, path, calib_loader):
+    from onnxruntime.quantization import (
+        CalibrationDataReader,
+        QuantFormat,
+        QuantType,
+        quantize_dynamic,
+        quantize_static,
+    )
+
+    class CalibrationReader(CalibrationDataReader):
+        def __init__(self, loader):
+            self.batches = iter(loader)
+
+        def get_next(self):
+            batch = next(self.batches, None)
+            return None if batch is None else {"images": batch[0].numpy()}
+
+    if c.export.quantize == "dynamic":
+        # Like torch, only the linear layers, integer convs are slower on CPU.
+        quantize_dynamic(
+            fp32_path,
+            path,
+            op_types_to_quantize=["MatMul", "Gemm"],
+            weight_type=QuantType.QInt8,
+        )
+    elif c.export.quantize == "static":
+        quantize_static(
+            fp32_path,
+            path,
+            CalibrationReader(calib_loader),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+        )
+
+    else:
+        raise Exception("Invalid quantization.")
+
+
+# ====================================================
+# Validation
+# ====================================================
+def validate_export(c, model, exported, df):
+    """Compares the post-processed oof predictions of the exported model with
+    the fp32 model."""
+    loader = make_loader(c, df)
+    preds = postprocess(c, predict(c, loader, [model, exported], torch.device("cpu")))
+    diff = np.abs(preds[1] - preds[0])
+    labels = df["Pawpularity"].values
+    return {
+        "n_data": len(df),
+        "max_diff": float(diff.max()),
+        "mean_diff": float(diff.mean()),
+        "fp32_score": get_score(labels, preds[0]),
+        "score": get_score(labels, preds[1]),
+        "passed": bool(diff.max() <= c.export.tolerance),
+    }
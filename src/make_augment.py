@@ -0,0 +1,167 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def make_batch_augment(c):
+    if c.params.batch_augment:
+        return BatchAugment(c)
+    return None
+
+
+class BatchAugment(nn.Module):
+    """Train augmentations of get_transforms applied to a whole batch at once.
+
+    Expects uint8 images of (N, C, H, W) on any device and returns normalized
+    float images. Each sample gets its own random parameters.
+    """
+
+    def __init__(self, c):
+        super().__init__()
+        self.hflip_p = 0.5
+        self.affine_p = 0.5
+        self.shift_limit = 0.2
+        self.scale_limit = 0.2
+        self.rotate_limit = 10
+        self.cutout_p = 0.5
+        self.cutout_size = int(c.params.size * 0.4)
+
+        mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1) * 255.0
+        std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1) * 255.0
+        self.register_buffer("mean", mean)
+        self.register_buffer("std", std)
+
+    @torch.no_grad()
+    def forward(self, images):
+        x = images.float()
+        x = self.hflip(x)
+        x = self.shift_scale_rotate(x)
+        x = self.cutout(x)
+        return (x - self.mean) / self.std
+
+    def hflip(self, x):
+        apply = torch.rand(x.size(0), device=x.device) < self.hflip_p
+        return torch.where(apply.view(-1, 1, 1, 1), x.flip(-1), x)
+
+    def shift_scale_rotate(self, x):
+        n, _, h, w = x.shape
+        # Samples that are not selected get the identity transform, which keeps
+        # the batch on a single grid_sample call without host syncs.
+        apply = (torch.rand(n, device=x.device) < self.affine_p).float()
+
+        angle = uniform(n, self.rotate_limit, x.device) * apply * math.pi / 180.0
+        scale = 1.0 + uniform(n, self.scale_limit, x.device) * apply
+        dx = uniform(n, self.shift_limit, x.device) * apply
+        dy = uniform(n, self.shift_limit, x.device) * apply
+
+        # Inverse of "rotate and scale around the center, then shift", expressed
+        # in the normalized coordinates that affine_grid works with.
+        cos = torch.cos(angle) / scale
+        sin = torch.sin(angle) / scale
+        a = torch.stack([cos, sin * h / w, -sin * w / h, cos], dim=1).view(n, 2, 2)
+        t = -torch.bmm(a, torch.stack([dx, dy], dim=1).unsqueeze(2) * 2.0)
+        theta = torch.cat([a, t], dim=2)
+
+        grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+        return F.grid_sample(
+            x, grid, mode="bilinear", padding_mode="zeros", align_corners=False
+        )
+
+    def cutout(self, x):
+        n, _, h, w = x.shape
+        apply = torch.rand(n, device=x.device) < self.cutout_p
+
+        cy = torch.randint(0, h, (n,), device=x.device)
+        cx = torch.randint(0, w, (n,), device=x.device)
+        y1 = (cy - self.cutout_size // 2).clamp(0, h)
+        x1 = (cx - self.cutout_size // 2).clamp(0, w)
+        y2 = (y1 + self.cutout_size).clamp(0, h)
+        x2 = (x1 + self.cutout_size).clamp(0, w)
+
+        ys = torch.arange(h, device=x.device).view(1, h, 1)
+        xs = torch.arange(w, device=x.device).view(1, 1, w)
+        mask = (
+            (ys >= y1.view(-1, 1, 1))
+            & (ys < y2.view(-1, 1, 1))
+            & (xs >= x1.view(-1, 1, 1))
+            & (xs < x2.view(-1, 1, 1))
+            & apply.view(-1, 1, 1)
+        )
+        return x.masked_fill(mask.unsqueeze(1), 0.0)
+
+
+def uniform(n, limit, device):
+    return (torch.rand(n, device=device) * 2.0 - 1.0) * limit
+
+
+def progressive_size(c, epoch, step, n_steps):
+    """Train size of a step, ramped linearly from min_size at the first epoch to
+    params.size after ramp_epochs, per epoch or per step."""
+    pr = c.params.progressive_resize
+    if not pr.enabled or pr.ramp_epochs <= 0:
+        return c.params.size
+
+    if pr.granularity == "epoch":
+        progress = epoch / pr.ramp_epochs
+    elif pr.granularity == "step":
+        progress = (epoch + step / n_steps) / pr.ramp_epochs
+    else:
+        raise Exception("Invalid progressive resize granularity.")
+    # The full size after the ramp, even if it is not a multiple.
+    if progress >= 1.0:
+        return c.params.size
+
+    size = pr.min_size + (c.params.size - pr.min_size) * progress
+    # Rounded down to the multiple, but never to zero when min_size is smaller.
+    size = max(int(size) // pr.multiple * pr.multiple, pr.multiple)
+    return min(size, c.params.size)
+
+
+def resize_batch(images, size):
+    return F.interpolate(
+        images.float(),
+        size=(size, size),
+        mode="bilinear",
+        align_corners=False,
+        antialias=True,
+    )
+
+
+def predict_tta(model, images, features, views):
+    """Runs all TTA views of a batch in one forward pass and averages per sample.
+
+    views is a list of "+" joined ops: identity, hflip and crop<percent>
+    (center crop resized back to the input size), e.g. ["identity", "hflip",
+    "crop90", "crop90+hflip"]. Outputs are averaged before post-processing.
+    """
+    if list(views) == ["identity"]:
+        return model(images, features)
+
+    x = torch.cat([tta_view(images, view) for view in views])
+    feats = features.repeat(len(views), *([1] * (features.dim() - 1)))
+    y = model(x, feats)
+    return y.view(len(views), images.size(0), *y.shape[1:]).mean(0)
+
+
+def tta_view(x, view):
+    for op in view.split("+"):
+        if op == "identity":
+            pass
+        elif op == "hflip":
+            x = x.flip(-1)
+        elif op.startswith("crop"):
+            h, w = x.shape[-2:]
+            ch = int(round(h * int(op[len("crop") :]) / 100.0))
+            cw = int(round(w * int(op[len("crop") :]) / 100.0))
+            top, left = (h - ch) // 2, (w - cw) // 2
+            x = F.interpolate(
+                x[..., top : top + ch, left : left + cw],
+                size=(h, w),
+                mode="bilinear",
+                align_corners=False,
+            )
+        else:
+            raise Exception("Invalid TTA view.")
+    return x
@@ -1,8 +1,16 @@
+import math
+
 import albumentations as A
 import cv2
+import numpy as np
 import torch
+import torch.distributed as dist
 from albumentations.pytorch import ToTensorV2
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Sampler
+from torch.utils.data.distributed import DistributedSampler
+
+from .make_image_cache import make_image_cache
+from .utils import is_distributed
 
 
 def make_dataset(c, df, transform=None, label=True):
@@ -14,40 +22,131 @@ def make_dataset(c, df, transform=None, label=True):
     return ds
 
 
-def make_dataloader(c, ds, shuffle, drop_last):
+def make_dataloader(c, ds, shuffle, drop_last, batch_size=None, sampler=None):
+    dl = c.settings.dataloader
+    num_workers = dl.num_workers
+    if sampler is not None:
+        shuffle = False
+    elif is_distributed():
+        sampler = DistributedSampler(
+            ds, shuffle=shuffle, seed=c.params.seed, drop_last=drop_last
+        )
+        shuffle = False
+
     dataloader = DataLoader(
         ds,
-        batch_size=c.params.batch_size,
+        batch_size=batch_size or c.params.batch_size,
         shuffle=shuffle,
-        num_workers=4,
-        pin_memory=True,
+        sampler=sampler,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
         drop_last=drop_last,
+        prefetch_factor=dl.prefetch_factor if num_workers > 0 else None,
+        persistent_workers=dl.persistent_workers and num_workers > 0,
     )
     return dataloader
 
 
+class FoldSampler(Sampler):
+    """Samples the rows of one fold out of a dataset over the full train frame.
+
+    set_indices switches the fold without rebuilding the DataLoader, so its
+    persistent workers are reused across folds. Shards like DistributedSampler
+    with DDP.
+    """
+
+    def __init__(self, shuffle, drop_last, seed=0):
+        self.indices = np.empty(0, dtype=np.int64)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+        self.num_replicas, self.rank = 1, 0
+        if is_distributed():
+            self.num_replicas, self.rank = dist.get_world_size(), dist.get_rank()
+
+    def set_indices(self, indices):
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    @property
+    def n_data(self):
+        return len(self.indices)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.indices) // self.num_replicas
+        return math.ceil(len(self.indices) / self.num_replicas)
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            # Every rank has to draw the same permutation with DDP.
+            g = None
+            if self.num_replicas > 1:
+                g = torch.Generator()
+                g.manual_seed(self.seed + self.epoch)
+            indices = indices[torch.randperm(len(indices), generator=g).numpy()]
+
+        total_size = len(self) * self.num_replicas
+        if total_size > len(indices):
+            indices = np.resize(indices, total_size)
+        indices = indices[:total_size]
+        return iter(indices[self.rank : total_size : self.num_replicas].tolist())
+
+
 class BaseDataset(Dataset):
+    """Holds only flat NumPy arrays, no DataFrame or Python string objects.
+
+    DataLoader workers touching Python objects update their refcounts, which
+    copies the pages holding them into every worker over an epoch.
+    """
+
     def __init__(self, c, df, transform=None, label=True):
-        self.df = df
-        self.file_names = df["Id"].values
-        self.features = df.drop(["Id", "Pawpularity", "fold", "bins"], axis=1).values
+        self.features = df.drop(
+            ["Id", "Pawpularity", "fold", "bins", "teacher"], axis=1, errors="ignore"
+        ).values.astype(np.float32)
         self.transform = transform
 
         self.use_label = label
         if self.use_label:
             self.path = c.settings.dirs.train_image
-            self.labels = df["Pawpularity"].values / 100.0
+            labels = df["Pawpularity"].values
+            if "teacher" in df.columns:
+                # Soft targets of distillation, see src/distill.py.
+                alpha = c.distill.alpha
+                labels = alpha * df["teacher"].values + (1.0 - alpha) * labels
+            self.labels = (labels / 100.0).astype(np.float32)
         else:
             self.path = c.settings.dirs.test_image
 
+        self.cache_path = None
+        if c.settings.image_cache.enabled:
+            self.cache_path, index = make_image_cache(c, self.path)
+            self.rows = np.array([index[f] for f in df["Id"].values], dtype=np.int64)
+        else:
+            # Fixed-width bytes, e.g. |S32 for the Ids of this competition.
+            self.file_names = df["Id"].values.astype(np.bytes_)
+        self.images = None
+
     def __len__(self):
-        return len(self.df)
+        return len(self.features)
 
     def __getitem__(self, idx):
-        file_name = self.file_names[idx]
-        file_path = f"{self.path}/{file_name}.jpg"
-        image = cv2.imread(file_path)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if self.cache_path is not None:
+            # Opened lazily so that each worker maps the cache itself.
+            # Copy-on-write keeps the slices writable without copying them.
+            if self.images is None:
+                self.images = np.load(self.cache_path, mmap_mode="c")
+            image = self.images[self.rows[idx]]
+        else:
+            file_name = self.file_names[idx].decode()
+            file_path = f"{self.path}/{file_name}.jpg"
+            image = cv2.imread(file_path)
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         feature = torch.tensor(self.features[idx])
         if self.transform:
             augmented = self.transform(image=image)
@@ -59,6 +158,15 @@ class BaseDataset(Dataset):
 
 
 def get_transforms(c, data):
+    if data == "train" and c.params.batch_augment:
+        # The rest of the train augmentations run on batches in BatchAugment.
+        return A.Compose(
+            [
+                A.Resize(c.params.size, c.params.size),
+                ToTensorV2(),
+            ]
+        )
+
     if data == "train":
         return A.Compose(
             [
@@ -0,0 +1,75 @@
+import hashlib
+import logging
+import os
+
+import numpy as np
+import torch
+
+from .make_dataset import make_dataloader, make_dataset
+from .make_model import BaseModel
+from .predict import load_state_dict
+
+log = logging.getLogger("__main__").getChild("make_embedding")
+
+
+def make_embedding(c, df, label, device, weights=None):
+    """Runs the frozen backbone once over df and caches pooled embeddings.
+
+    weights is "pretrained" or a checkpoint path, c.head.weights by default.
+    The cache is keyed by model_name, size, the content of the backbone weights
+    and the Ids of df, and stored as float16 with one row per row of df.
+    """
+    weights = weights or c.head.weights
+    weights_key = (
+        weights
+        if weights == "pretrained"
+        else f"{os.path.splitext(os.path.basename(weights))[0]}-{file_hash(weights)}"
+    )
+    ids_key = hashlib.sha1("".join(df["Id"].values).encode()).hexdigest()[:8]
+    path = os.path.join(
+        c.settings.dirs.cache,
+        "embeddings",
+        f"{c.params.model_name.replace('/', '-')}_{c.params.size}_{weights_key}_{ids_key}.npy",
+    )
+
+    if os.path.exists(path):
+        log.info(f"Using embedding cache: {path}")
+        return np.load(path)
+
+    log.info(f"Building embedding cache: {path}")
+    model = BaseModel(c, pretrained=(weights == "pretrained"))
+    if weights != "pretrained":
+        model.load_state_dict(load_state_dict(weights))
+    model.model.reset_classifier(0)
+    model.to(device)
+    model.eval()
+
+    ds = make_dataset(c, df, "valid", label=label)
+    loader = make_dataloader(c, ds, shuffle=False, drop_last=False)
+
+    embeddings = None
+    start = 0
+    with torch.inference_mode():
+        for batch in loader:
+            images = batch[0].to(device)
+            y = model.model(images).float().cpu().numpy()
+            if embeddings is None:
+                embeddings = np.empty((len(ds), y.shape[1]), dtype=np.float16)
+            embeddings[start : start + len(y)] = y
+            start += len(y)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, embeddings)
+    os.replace(tmp_path, path)
+    return embeddings
+
+
+def file_hash(path, chunk_size=2**20):
+    """Checkpoints of a retrained fold keep their file name, so the cache is
+    keyed by their content."""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()[:8]
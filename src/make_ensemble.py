@@ -0,0 +1,153 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import nnls
+
+from .get_score import get_score
+from .prediction_store import has_predictions, load_predictions
+
+log = logging.getLogger("__main__").getChild("make_ensemble")
+
+
+def load_oof_matrix(c, df, base_results):
+    """Loads the oof predictions of base_results into an (n_samples, n_models)
+    matrix, aligned by Id to the rows of df, and the folds they are oof of.
+
+    Reads the memory mapped columns of the prediction store, and falls back to
+    oof_df.csv for runs saved before it. The fold of a row is the one stored
+    with the first base result, the others are expected to agree.
+
+    Rows that are missing from any of the base results are dropped, like an
+    inner merge. Returns the kept rows of df, the matrix and the folds.
+    """
+    index = pd.Index(df["Id"].values)
+    x = np.full((len(df), len(base_results)), np.nan)
+    folds = np.full(len(df), -1, dtype=np.int64)
+    mismatch = np.zeros(len(df), dtype=bool)
+
+    last_ids, rows = None, None
+    for n, base in enumerate(base_results):
+        base_dir = os.path.join(c.settings.dirs.working, "..", "base_results", base)
+        if has_predictions(base_dir):
+            values, _ = load_predictions(base_dir, columns=("ids", "preds", "folds"))
+            ids, preds, base_folds = values["ids"], values["preds"], values["folds"]
+            # Runs on the same folds share the Id order, so align only once.
+            if last_ids is None or not np.array_equal(ids, last_ids):
+                rows = index.get_indexer(ids.astype(str))
+                last_ids = ids
+        else:
+            oof = pd.read_csv(
+                os.path.join(base_dir, "oof_df.csv"), usecols=["Id", "fold", "preds"]
+            )
+            rows = index.get_indexer(oof["Id"].values)
+            preds, base_folds = oof["preds"].values, oof["fold"].values
+            last_ids = None
+
+        found = rows >= 0
+        x[rows[found], n] = preds[found]
+
+        rows, base_folds = rows[found], np.asarray(base_folds)[found]
+        known = folds[rows] >= 0
+        mismatch[rows[known]] |= folds[rows[known]] != base_folds[known]
+        folds[rows[~known]] = base_folds[~known]
+
+    keep = ~np.isnan(x).any(axis=1)
+    if not keep.all():
+        log.warning(f"Drop {(~keep).sum()} rows missing from some base results.")
+    if mismatch[keep].any():
+        log.warning(
+            f"Folds of the base results differ on {mismatch[keep].sum()} rows, "
+            "use the folds of the first one."
+        )
+    return df[keep].reset_index(drop=True), x[keep], folds[keep]
+
+
+def make_ensemble(c, x, y, folds, method):
+    """Fits blending weights with fold-aware CV.
+
+    Returns the oof blend of the held-out folds, its score and the weights fit
+    on all rows.
+    """
+    preds = np.empty(len(y))
+    for fold in np.unique(folds):
+        trn = folds != fold
+        w = fit_weights(c, x[trn], y[trn], method)
+        preds[~trn] = x[~trn] @ w
+
+    score = get_score(y, preds)
+    weights = fit_weights(c, x, y, method)
+    return preds, score, weights
+
+
+def fit_weights(c, x, y, method):
+    if method == "mean":
+        w = np.full(x.shape[1], 1.0 / x.shape[1])
+    elif method == "nnls":
+        # Same solution from the R of x = QR, which is only (n_models, n_models).
+        q, r = np.linalg.qr(x)
+        w, _ = nnls(r, q.T @ y)
+    elif method == "rmse":
+        w = fit_simplex(x, y, c.validate.rmse.n_iter)
+    elif method == "hill_climb":
+        w = fit_hill_climb(x, y, c.validate.hill_climb.n_iter)
+
+    else:
+        raise Exception("Invalid ensemble method.")
+    return w
+
+
+def fit_simplex(x, y, n_iter):
+    """Minimizes RMSE with non-negative weights that sum to one.
+
+    Accelerated projected gradient on the Gram matrix, so each step is
+    O(n_models^2) regardless of the number of samples.
+    """
+    n, m = x.shape
+    g = x.T @ x / n
+    b = x.T @ y / n
+    step = 1.0 / np.linalg.eigvalsh(g)[-1]
+
+    w = np.full(m, 1.0 / m)
+    v, t = w, 1.0
+    for _ in range(n_iter):
+        w_next = project_simplex(v - step * (g @ v - b))
+        t_next = (1.0 + np.sqrt(1.0 + 4.0 * t * t)) / 2.0
+        v = w_next + (t - 1.0) / t_next * (w_next - w)
+        w, t = w_next, t_next
+    return w
+
+
+def project_simplex(v):
+    """Euclidean projection onto {w >= 0, sum(w) = 1}."""
+    u = np.sort(v)[::-1]
+    css = np.cumsum(u) - 1.0
+    k = np.arange(1, len(v) + 1)
+    rho = np.nonzero(u - css / k > 0)[0][-1]
+    return np.maximum(v - css[rho] / (rho + 1), 0.0)
+
+
+def fit_hill_climb(x, y, n_iter):
+    """Greedy forward selection with replacement.
+
+    Each step adds the model that lowers the squared error of the running
+    average the most, evaluating all models with one matrix-vector product.
+    """
+    m = x.shape[1]
+    sq_norms = (x * x).sum(axis=0)
+    counts = np.zeros(m)
+    total = np.zeros(len(y))
+    best = np.inf
+
+    for k in range(n_iter):
+        # |total + x_j - (k + 1) y|^2 for every j
+        r = total - (k + 1) * y
+        errors = (r @ r + 2.0 * (r @ x) + sq_norms) / (k + 1) ** 2
+        j = np.argmin(errors)
+        if errors[j] >= best:
+            break
+        best = errors[j]
+        counts[j] += 1
+        total += x[:, j]
+    return counts / counts.sum()
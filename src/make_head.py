@@ -0,0 +1,72 @@
+import torch
+import torch.nn as nn
+from sklearn.linear_model import Ridge
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import SVR
+
+from .make_loss import make_criterion
+from .predict import postprocess
+
+
+# ====================================================
+# Regression heads on cached embeddings
+# ====================================================
+def make_head(c):
+    if c.head.type == "ridge":
+        head = make_pipeline(StandardScaler(), Ridge(alpha=c.head.alpha))
+    elif c.head.type == "svr":
+        head = make_pipeline(StandardScaler(), SVR(C=c.head.C))
+    elif c.head.type == "mlp":
+        head = MLPHead(c)
+
+    else:
+        raise Exception("Invalid head.")
+    return head
+
+
+class MLPHead:
+    """Linear (hidden: 0) or one hidden layer head trained full-batch with the
+    same criterion and post-processing as BaseModel."""
+
+    def __init__(self, c):
+        self.c = c
+        self.scaler = StandardScaler()
+        self.model = None
+
+    def fit(self, x, y):
+        torch.manual_seed(self.c.params.seed)
+        x = torch.tensor(self.scaler.fit_transform(x), dtype=torch.float32)
+        y = torch.tensor(y / 100.0, dtype=torch.float32)
+
+        if self.c.head.hidden > 0:
+            self.model = nn.Sequential(
+                nn.Linear(x.shape[1], self.c.head.hidden),
+                nn.ReLU(),
+                nn.Linear(self.c.head.hidden, self.c.settings.n_class),
+            )
+        else:
+            self.model = nn.Linear(x.shape[1], self.c.settings.n_class)
+
+        criterion = make_criterion(self.c)
+        optimizer = torch.optim.Adam(
+            self.model.parameters(),
+            lr=self.c.head.lr,
+            weight_decay=self.c.params.weight_decay,
+        )
+
+        self.model.train()
+        for _ in range(self.c.head.epoch):
+            optimizer.zero_grad(set_to_none=True)
+            loss = criterion(self.model(x).squeeze(1), y)
+            loss.backward()
+            optimizer.step()
+
+        return self
+
+    def predict(self, x):
+        x = torch.tensor(self.scaler.transform(x), dtype=torch.float32)
+        self.model.eval()
+        with torch.inference_mode():
+            y = self.model(x).squeeze(1).numpy()
+        return postprocess(self.c, y)
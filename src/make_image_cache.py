@@ -0,0 +1,72 @@
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+log = logging.getLogger("__main__").getChild("make_image_cache")
+
+_caches = {}
+
+
+def make_image_cache(c, image_dir):
+    """Decode and resize every image in image_dir once into a uint8 memmap.
+
+    The cache is keyed by size and a fingerprint of the source files, so it is
+    only rebuilt when the inputs change.
+    Returns the path of the cache array and a dict that maps Id to row.
+    """
+    size = c.settings.image_cache.size
+    if (image_dir, size) in _caches:
+        return _caches[(image_dir, size)]
+
+    file_names = sorted(f for f in os.listdir(image_dir) if f.endswith(".jpg"))
+    key = fingerprint(image_dir, file_names, size)
+    name = os.path.basename(os.path.normpath(image_dir))
+    path = os.path.join(c.settings.dirs.cache, "images", f"{name}_{size}_{key}")
+
+    if not os.path.exists(f"{path}.npy"):
+        log.info(f"Building image cache: {path}.npy ({len(file_names)} images)")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        build_image_cache(image_dir, file_names, size, path)
+    else:
+        log.info(f"Using image cache: {path}.npy")
+
+    ids = np.load(f"{path}_index.npy")
+    index = {id_: n for n, id_ in enumerate(ids)}
+
+    _caches[(image_dir, size)] = (f"{path}.npy", index)
+    return _caches[(image_dir, size)]
+
+
+def fingerprint(image_dir, file_names, size):
+    h = hashlib.sha1(str(size).encode())
+    for f in file_names:
+        st = os.stat(os.path.join(image_dir, f))
+        h.update(f"{f}:{st.st_size}:{st.st_mtime_ns}".encode())
+    return h.hexdigest()[:12]
+
+
+def build_image_cache(image_dir, file_names, size, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+    images = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype=np.uint8, shape=(len(file_names), size, size, 3)
+    )
+
+    def load(n):
+        image = cv2.imread(os.path.join(image_dir, file_names[n]))
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        images[n] = cv2.resize(image, (size, size))
+
+    # cv2 releases the GIL while decoding, so threads are enough here.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(load, range(len(file_names))))
+    images.flush()
+    del images
+
+    ids = np.array([os.path.splitext(f)[0] for f in file_names])
+    np.save(f"{path}_index.npy", ids)
+    # The array is moved into place last, so its existence marks a complete cache.
+    os.replace(tmp_path, f"{path}.npy")
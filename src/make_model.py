@@ -1,6 +1,9 @@
 import timm
-import torch.cuda.amp as amp
+import torch
 import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
+from .utils import autocast, is_distributed
 
 
 def make_model(c):
@@ -9,7 +12,15 @@ def make_model(c):
     else:
         model = BaseModel(c)
 
-    if c.settings.multi_gpu:
+    if is_distributed():
+        if torch.cuda.is_available():
+            device = torch.cuda.current_device()
+            model = DistributedDataParallel(
+                model.to(device), device_ids=[device], output_device=device
+            )
+        else:
+            model = DistributedDataParallel(model)
+    elif c.settings.multi_gpu:
         model = nn.DataParallel(model)
     return model
 
@@ -29,10 +40,37 @@ class BaseModel(nn.Module):
         if "convmixer" in self.model_name:
             self.head = nn.Linear(1000, c.settings.n_class)
 
+        e = c.settings.execution
+        if e.grad_checkpointing:
+            # Recomputes activations of each block in backward instead of keeping them.
+            set_grad_checkpointing(self.model, self.model_name)
+        self.cpu_dtype = e.cpu_dtype
+        self.channels_last = e.channels_last
+        if self.channels_last:
+            self.to(memory_format=torch.channels_last)
+        if e.compile:
+            # In place, so state_dict keys stay the same as without compile.
+            self.model.compile(mode=e.compile_mode)
+
     def forward(self, x, feats):
-        with amp.autocast(enabled=self.amp):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        with autocast(x.device.type, self.amp, self.cpu_dtype):
             x = self.model(x)
             if "convmixer" in self.model_name:
                 x = self.head(x)
 
         return x
+
+
+def set_grad_checkpointing(model, model_name):
+    # Unsupported timm models either lack the method or assert in it.
+    try:
+        if not hasattr(model, "set_grad_checkpointing"):
+            raise NotImplementedError
+        model.set_grad_checkpointing(True)
+    except (AssertionError, NotImplementedError):
+        raise Exception(
+            f"Invalid settings.execution.grad_checkpointing, {model_name} does not "
+            "support gradient checkpointing."
+        )
@@ -0,0 +1,77 @@
+import copy
+import logging
+
+import numpy as np
+
+from .distill import select_teacher
+from .make_dataset import FoldSampler, make_dataloader, make_dataset
+from .tune_dataloader import tune_dataloader
+
+log = logging.getLogger("__main__").getChild("make_pipeline")
+
+
+def make_pipeline(c, df, device, fold=None):
+    return FoldPipeline(c, df, device, fold)
+
+
+class FoldPipeline:
+    """Datasets and DataLoaders over the full train frame, built once per run.
+
+    The DataLoaders keep their workers alive, and set_fold only changes which
+    rows the samplers yield, so the workers are started once and reused by
+    every fold and epoch.
+
+    The soft targets of distillation depend on the fold, see src/distill.py, so
+    with them the pipeline serves only the fold it is built for, and the
+    validation rows keep their labels.
+    """
+
+    def __init__(self, c, df, device, fold=None):
+        self.folds = df["fold"].values
+
+        self.fold = None
+        train_df = valid_df = df
+        if "teacher" in df.columns:
+            if fold is None:
+                raise Exception("Soft targets need the fold of the pipeline.")
+            self.fold = fold
+            train_df = select_teacher(df, fold)
+            valid_df = select_teacher(df)
+
+        train_ds = make_dataset(c, train_df, "train")
+        valid_ds = make_dataset(c, valid_df, "valid")
+
+        c = copy.deepcopy(tune_dataloader(c, train_ds, valid_ds, device))
+        c.settings.dataloader.persistent_workers = True
+
+        self.train_sampler = FoldSampler(
+            shuffle=True, drop_last=True, seed=c.params.seed
+        )
+        self.valid_sampler = FoldSampler(shuffle=False, drop_last=False)
+
+        self.train_loader = make_dataloader(
+            c, train_ds, shuffle=True, drop_last=True, sampler=self.train_sampler
+        )
+        self.valid_loader = make_dataloader(
+            c,
+            valid_ds,
+            shuffle=False,
+            drop_last=False,
+            batch_size=c.settings.dataloader.valid_batch_size,
+            sampler=self.valid_sampler,
+        )
+
+    def serves(self, fold):
+        return self.fold is None or self.fold == fold
+
+    def set_fold(self, fold):
+        if not self.serves(fold):
+            raise Exception(
+                f"Invalid fold {fold} for the pipeline of fold {self.fold}."
+            )
+        # Rows are positional, the same order as df.loc[df["fold"] == fold].
+        self.train_sampler.set_indices(np.flatnonzero(self.folds != fold))
+        self.valid_sampler.set_indices(np.flatnonzero(self.folds == fold))
+
+    def set_epoch(self, epoch):
+        self.train_sampler.set_epoch(epoch)
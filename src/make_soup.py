@@ -0,0 +1,181 @@
+import logging
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from .get_score import get_score
+from .make_dataset import make_dataloader, make_dataset
+from .predict import checkpoint_path, load_state_dict, postprocess, predict
+
+log = logging.getLogger("__main__").getChild("make_soup")
+
+
+def load_fold_states(c, model_dir):
+    """Returns the best state_dict of each fold, keyed by fold."""
+    states = {}
+    for fold in range(c.params.n_fold):
+        path = checkpoint_path(c, model_dir, fold)
+        if not os.path.exists(path):
+            log.warning(f"Checkpoint is not found: {path}")
+            continue
+        states[fold] = load_state_dict(path)
+
+    if len(states) == 0:
+        raise Exception(f"No checkpoint found in {model_dir}.")
+    return states
+
+
+def average_states(states):
+    """Uniform average of the floating point tensors, the others (e.g. the
+    num_batches_tracked of BatchNorm) are taken from the first state."""
+    soup = {}
+    for key, value in states[0].items():
+        if value.is_floating_point():
+            soup[key] = (
+                torch.stack([state[key].float() for state in states])
+                .mean(0)
+                .to(value.dtype)
+            )
+        else:
+            soup[key] = value.clone()
+    return soup
+
+
+class SoupScorer:
+    """Predicts the eval rows with weights loaded into one model.
+
+    Averaged weights do not match the averaged BatchNorm statistics, so those
+    are re-estimated on bn_loader first when the model has any.
+    """
+
+    def __init__(self, c, model, eval_df, train_df, device):
+        self.c = c
+        self.model = model
+        self.device = device
+        self.labels = eval_df["Pawpularity"].values
+        self.folds = eval_df["fold"].values
+
+        eval_ds = make_dataset(c, eval_df.reset_index(drop=True), "valid")
+        self.eval_loader = make_dataloader(c, eval_ds, shuffle=False, drop_last=False)
+        # Statistics of the inputs at inference, so without train augmentations,
+        # and the same rows for every soup.
+        bn_df = train_df.sample(
+            n=min(c.soup.n_bn_batches * c.params.batch_size, len(train_df)),
+            random_state=c.params.seed,
+        )
+        bn_ds = make_dataset(c, bn_df.reset_index(drop=True), "valid")
+        self.bn_loader = make_dataloader(c, bn_ds, shuffle=False, drop_last=True)
+
+        self.bns = [
+            m for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)
+        ]
+
+    def predict(self, state, update_bn=True):
+        self.model.load_state_dict(state)
+        if update_bn and len(self.bns) > 0:
+            self.update_bn()
+        self.model.eval()
+        preds = predict(self.c, self.eval_loader, [self.model], self.device)
+        return postprocess(self.c, preds)[0]
+
+    def rows(self, folds):
+        """Eval rows of folds, the oof rows of the fold models of a soup."""
+        return np.isin(self.folds, list(folds))
+
+    def score(self, preds, folds):
+        rows = self.rows(folds)
+        return get_score(self.labels[rows], preds[rows])
+
+    def update_bn(self):
+        momenta = [bn.momentum for bn in self.bns]
+        for bn in self.bns:
+            bn.reset_running_stats()
+            # Cumulative average over the batches.
+            bn.momentum = None
+
+        self.model.train()
+        with torch.no_grad():
+            for batch in self.bn_loader:
+                self.model(batch[0].to(self.device), batch[1].to(self.device))
+
+        for bn, momentum in zip(self.bns, momenta):
+            bn.momentum = momentum
+
+
+def make_soup(states, method, fold_scores, tolerance=0.0):
+    """Returns the soup of states and the folds it is made of.
+
+    uniform averages every fold. greedy takes the folds in the order of their
+    oof score, as long as it is within tolerance of the best one. Every row has
+    been trained on by some fold of a soup of two or more, so a soup score can
+    not pick the folds, only the oof scores of the fold models do.
+    """
+    if method == "uniform":
+        folds = list(states)
+    elif method == "greedy":
+        order = sorted(states, key=lambda fold: fold_scores[fold])
+        best = fold_scores[order[0]]
+        folds = [fold for fold in order if fold_scores[fold] <= best + tolerance]
+        log.info(
+            f"greedy: folds {folds} of oof scores within {tolerance} of {best:.5f}"
+        )
+
+    else:
+        raise Exception("Invalid soup method.")
+    return average_states([states[fold] for fold in folds]), folds
+
+
+def unseen_rows(row_folds, folds):
+    """Rows that none of the fold models of folds has been trained on.
+
+    A fold model is trained on every row out of its own fold, so only a soup of
+    a single fold has any.
+    """
+    return np.logical_and.reduce([row_folds == fold for fold in folds])
+
+
+def soup_score(labels, row_folds, preds, oof, folds):
+    """Returns the score of the soup of folds, the oof score on the same rows
+    and whether the soup score is optimistic.
+
+    Rows none of the folds has been trained on are scored. Without any, the
+    soup is scored on the oof rows of its folds, which it has partly been
+    trained on, so its score is optimistic and not comparable to the oof one.
+    """
+    rows = unseen_rows(row_folds, folds)
+    optimistic = not rows.any()
+    if optimistic:
+        rows = np.isin(row_folds, list(folds))
+    return (
+        get_score(labels[rows], preds[rows]),
+        get_score(labels[rows], oof[rows]),
+        optimistic,
+    )
+
+
+def fold_predictions(states, scorer):
+    """Predictions of each fold model on the eval rows, with their own
+    BatchNorm statistics."""
+    return {
+        fold: scorer.predict(state, update_bn=False) for fold, state in states.items()
+    }
+
+
+def oof_predictions(scorer, preds):
+    """Prediction of each eval row by the fold model that has not been trained
+    on it, NaN for rows of folds without a model."""
+    oof = np.full(len(scorer.labels), np.nan)
+    for fold, fold_preds in preds.items():
+        rows = scorer.rows([fold])
+        oof[rows] = fold_preds[rows]
+    return oof
+
+
+def oof_scores(scorer, preds):
+    """Score of each fold model on the eval rows of its own fold."""
+    return {
+        fold: scorer.score(fold_preds, [fold]) if scorer.rows([fold]).any() else np.inf
+        for fold, fold_preds in preds.items()
+    }
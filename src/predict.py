@@ -0,0 +1,121 @@
+import copy
+import logging
+import os
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from .make_augment import predict_tta
+from .make_model import BaseModel
+
+log = logging.getLogger("__main__").getChild("predict")
+
+
+def load_base_config(c, base_dir):
+    """Returns c with params replaced by the ones the base result was trained with."""
+    c = copy.deepcopy(c)
+    path = os.path.join(base_dir, ".hydra", "config.yaml")
+    if os.path.exists(path):
+        c.params = OmegaConf.merge(c.params, OmegaConf.load(path).params)
+    else:
+        log.warning(f"Training config is not found, use current params: {path}")
+    return c
+
+
+def load_state_dict(path):
+    state_dict = torch.load(path, map_location="cpu")
+    # Checkpoints saved from nn.DataParallel have "module." prefixed keys.
+    return {
+        (k[len("module.") :] if k.startswith("module.") else k): v
+        for k, v in state_dict.items()
+    }
+
+
+def load_fold_models(c, model_dir, device):
+    """Builds BaseModel once and loads each fold's best weights into a copy of it.
+
+    Every fold stays in memory, as the server needs. Batch inference runs the
+    folds one after another with predict_folds.
+    """
+    model = BaseModel(c, pretrained=False)
+
+    models = []
+    for fold in range(c.params.n_fold):
+        path = checkpoint_path(c, model_dir, fold)
+        if not os.path.exists(path):
+            log.warning(f"Checkpoint is not found: {path}")
+            continue
+
+        fold_model = copy.deepcopy(model)
+        fold_model.load_state_dict(load_state_dict(path))
+        fold_model.to(device)
+        fold_model.eval()
+        models.append(fold_model)
+
+    if len(models) == 0:
+        raise Exception(f"No checkpoint found in {model_dir}.")
+    return models
+
+
+def checkpoint_path(c, model_dir, fold):
+    model_name = c.params.model_name.replace("/", "-")
+    return os.path.join(model_dir, f"{model_name}_fold{fold}_best.pth")
+
+
+def predict(c, loader, models, device):
+    """Streams the loader once and runs every fold model on each batch.
+
+    TTA views of c.params.tta are stacked into the same forward pass. Labels of
+    the loader, if any, are ignored.
+
+    Returns raw outputs with the shape of (n_models, n_samples).
+    """
+    preds = np.empty((len(models), len(loader.dataset)), dtype=np.float32)
+
+    start = 0
+    with torch.inference_mode():
+        for batch in loader:
+            images = batch[0].to(device)
+            features = batch[1].to(device)
+            end = start + images.size(0)
+
+            for n, model in enumerate(models):
+                y_preds = predict_tta(model, images, features, c.params.tta)
+                preds[n, start:end] = y_preds.squeeze(1).float().cpu()
+
+            start = end
+
+    return preds
+
+
+def predict_folds(c, loader, model_dir, device):
+    """Loads each fold's best weights into a single BaseModel in turn and
+    predicts the loader with it, so only one model is in memory.
+
+    Returns raw outputs with the shape of (n_folds, n_samples).
+    """
+    model = BaseModel(c, pretrained=False).to(device)
+
+    preds = []
+    for fold in range(c.params.n_fold):
+        path = checkpoint_path(c, model_dir, fold)
+        if not os.path.exists(path):
+            log.warning(f"Checkpoint is not found: {path}")
+            continue
+
+        model.load_state_dict(load_state_dict(path))
+        model.eval()
+        preds.append(predict(c, loader, [model], device)[0])
+
+    if len(preds) == 0:
+        raise Exception(f"No checkpoint found in {model_dir}.")
+    return np.stack(preds)
+
+
+def postprocess(c, preds):
+    """Same post-processing as train_fold."""
+    if "WithLogitsLoss" in c.params.criterion:
+        preds = 1 / (1 + np.exp(-preds))
+
+    return preds * 100.0
@@ -0,0 +1,75 @@
+import hashlib
+import json
+import logging
+import os
+
+import git
+import numpy as np
+from omegaconf import OmegaConf
+
+from .utils import get_commit_hash
+
+log = logging.getLogger("__main__").getChild("prediction_store")
+
+
+def save_predictions(c, df, name="oof"):
+    """Writes the Id, fold and preds columns of df as .npy files plus metadata.
+
+    Every run owns its own files, so adding a run never rewrites the others,
+    and readers can memory map only the columns they need.
+    """
+    meta = {
+        "model_name": c.params.model_name,
+        "n_fold": c.params.n_fold,
+        "epoch": c.params.epoch,
+        "config_hash": config_hash(c),
+        "commit": commit_hash(c),
+        "n_data": len(df),
+    }
+    columns = {
+        "ids": df["Id"].values.astype(np.bytes_),
+        "preds": df["preds"].values.astype(np.float32),
+    }
+    if "fold" in df.columns:
+        columns["folds"] = df["fold"].values.astype(np.int8)
+
+    for column, values in columns.items():
+        _save_atomic(f"{name}_{column}.npy", values)
+
+    path = f"{name}_meta.json"
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_predictions(run_dir, name="oof", columns=("ids", "preds")):
+    """Returns the memory mapped columns and the metadata of a run."""
+    values = {
+        column: np.load(os.path.join(run_dir, f"{name}_{column}.npy"), mmap_mode="r")
+        for column in columns
+    }
+    with open(os.path.join(run_dir, f"{name}_meta.json")) as f:
+        meta = json.load(f)
+    return values, meta
+
+
+def has_predictions(run_dir, name="oof"):
+    return os.path.exists(os.path.join(run_dir, f"{name}_meta.json"))
+
+
+def config_hash(c):
+    params = OmegaConf.to_yaml(c.params, resolve=True, sort_keys=True)
+    return hashlib.sha1(params.encode()).hexdigest()[:8]
+
+
+def commit_hash(c):
+    try:
+        return get_commit_hash(c.settings.dirs.working)
+    except git.exc.InvalidGitRepositoryError:
+        return None
+
+
+def _save_atomic(path, values):
+    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, values)
+    os.replace(tmp_path, path)
@@ -0,0 +1,103 @@
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+
+from .utils import sync
+
+log = logging.getLogger("__main__").getChild("runtime")
+
+
+def load_runtime_models(c, base_dir):
+    """Loads the exported fold models of base_dir for c.inference.runtime.
+
+    Exported with export.py. Returns models called like BaseModel, so predict
+    and TTA work the same with any runtime.
+    """
+    fmt = c.inference.runtime
+    models = []
+    for fold in range(c.params.n_fold):
+        path = os.path.join(base_dir, c.export.dir, artifact_name(c, fold, fmt))
+        if not os.path.exists(path):
+            log.warning(f"Exported model is not found: {path}")
+            continue
+        models.append(load_runtime_model(c, path))
+
+    if len(models) == 0:
+        raise Exception(f"No exported model found in {base_dir}.")
+    return models
+
+
+def artifact_name(c, fold, fmt):
+    model_name = c.params.model_name.replace("/", "-")
+    quantize = "fp32" if c.export.quantize == "none" else f"int8-{c.export.quantize}"
+    ext = {"torchscript": "pt", "onnx": "onnx"}[fmt]
+    return f"{model_name}_fold{fold}_{quantize}.{ext}"
+
+
+def load_runtime_model(c, path):
+    if path.endswith(".pt"):
+        # Int8 models run on the engine they were quantized for.
+        torch.backends.quantized.engine = c.export.backend
+        return TorchScriptModel(path)
+    elif path.endswith(".onnx"):
+        return OnnxModel(path, c.inference.n_threads)
+
+    else:
+        raise Exception("Invalid runtime model.")
+
+
+class TorchScriptModel(object):
+    def __init__(self, path):
+        self.module = torch.jit.load(path, map_location="cpu")
+        self.module.eval()
+
+    def __call__(self, x, feats):
+        return self.module(x.cpu())
+
+
+class OnnxModel(object):
+    def __init__(self, path, n_threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if n_threads > 0:
+            options.intra_op_num_threads = n_threads
+        self.session = ort.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+
+    def __call__(self, x, feats):
+        preds = self.session.run(None, {"images": x.cpu().numpy()})[0]
+        return torch.from_numpy(preds)
+
+
+def benchmark_runtime(model, batch_sizes, size, n_iter, device=torch.device("cpu")):
+    """Measures the latency of one forward pass and the throughput per batch size."""
+    results = []
+    for batch_size in batch_sizes:
+        x = torch.randn(batch_size, 3, size, size, device=device)
+        feats = torch.zeros(batch_size, 0, device=device)
+
+        with torch.inference_mode():
+            model(x, feats)
+            times = []
+            for _ in range(n_iter):
+                start = time.perf_counter()
+                model(x, feats)
+                sync(device)
+                times.append(time.perf_counter() - start)
+
+        times = np.array(times) * 1000.0
+        results.append(
+            {
+                "batch_size": batch_size,
+                "latency_p50_ms": float(np.percentile(times, 50)),
+                "latency_p90_ms": float(np.percentile(times, 90)),
+                "images_per_sec": batch_size * 1000.0 / float(np.mean(times)),
+            }
+        )
+    return results
@@ -0,0 +1,295 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+
+from .make_augment import predict_tta
+from .make_dataset import get_transforms
+from .predict import postprocess
+
+log = logging.getLogger("__main__").getChild("serve")
+
+STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Server Error"}
+
+
+class Ensemble(object):
+    """Fold models of the base results, averaged like infer.py.
+
+    Each base result keeps its own config, so models trained at different sizes
+    get their own preprocessing of the same image.
+    """
+
+    def __init__(self, configs, models, device):
+        self.configs = configs
+        self.models = models
+        self.transforms = [get_transforms(bc, "valid") for bc in configs]
+        self.device = device
+
+    def preprocess(self, data):
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Invalid image.")
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        return [transform(image=image)["image"] for transform in self.transforms]
+
+    def predict(self, batch):
+        """Returns the Pawpularity of preprocessed images, with one forward per
+        fold model for the whole batch."""
+        preds = np.zeros(len(batch), dtype=np.float32)
+        with torch.inference_mode():
+            for n, (bc, models) in enumerate(zip(self.configs, self.models)):
+                images = torch.stack([views[n] for views in batch]).to(self.device)
+                # Metadata is not used by BaseModel.
+                features = torch.zeros(len(batch), 0, device=self.device)
+                fold_preds = np.stack(
+                    [
+                        predict_tta(model, images, features, bc.params.tta)
+                        .squeeze(1)
+                        .float()
+                        .cpu()
+                        .numpy()
+                        for model in models
+                    ]
+                )
+                preds += postprocess(bc, fold_preds).mean(axis=0)
+        return preds / len(self.models)
+
+
+class MicroBatcher(object):
+    """Collects concurrent requests into batches of up to max_batch_size.
+
+    A batch is run when it is full, or when its oldest request has waited
+    max_wait_ms. Forwards run in their own thread, so requests keep being
+    accepted and preprocessed meanwhile.
+    """
+
+    def __init__(self, predict_fn, max_batch_size, max_wait_ms, metrics):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.metrics = metrics
+        self.pending = []
+        self.event = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future, loop.time()))
+        self.event.set()
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if len(self.pending) == 0:
+                self.event.clear()
+                await self.event.wait()
+
+            deadline = self.pending[0][2] + self.max_wait
+            while len(self.pending) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                self.event.clear()
+                try:
+                    await asyncio.wait_for(self.event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            batch = self.pending[: self.max_batch_size]
+            self.pending = self.pending[self.max_batch_size :]
+            self.metrics.update_batch(len(batch), loop.time() - batch[0][2])
+
+            try:
+                preds = await loop.run_in_executor(
+                    self.executor, self.predict_fn, [item for item, _, _ in batch]
+                )
+            except Exception as e:
+                log.exception("Batch failed.")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future, _), pred in zip(batch, preds):
+                # The client may have gone away.
+                if not future.done():
+                    future.set_result(float(pred))
+
+
+class ServeMetrics(object):
+    """Latency percentiles and throughput over the latest window requests."""
+
+    def __init__(self, window):
+        self.latencies = deque(maxlen=window)
+        self.finished = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.queue_waits = deque(maxlen=window)
+        self.n_requests = 0
+        self.n_errors = 0
+        self.start = time.time()
+
+    def update(self, latency):
+        self.latencies.append(latency)
+        self.finished.append(time.time())
+        self.n_requests += 1
+
+    def update_batch(self, batch_size, queue_wait):
+        self.batch_sizes.append(batch_size)
+        self.queue_waits.append(queue_wait)
+
+    def summary(self):
+        summary = {
+            "n_requests": self.n_requests,
+            "n_errors": self.n_errors,
+            "uptime_sec": time.time() - self.start,
+        }
+        if len(self.latencies) > 0:
+            latencies = np.array(self.latencies) * 1000.0
+            elapsed = self.finished[-1] - self.finished[0]
+            summary.update(
+                {
+                    "latency_p50_ms": float(np.percentile(latencies, 50)),
+                    "latency_p95_ms": float(np.percentile(latencies, 95)),
+                    "latency_p99_ms": float(np.percentile(latencies, 99)),
+                    "requests_per_sec": (
+                        (len(self.finished) - 1) / elapsed if elapsed > 0 else 0.0
+                    ),
+                    "mean_batch_size": float(np.mean(self.batch_sizes)),
+                    "mean_queue_wait_ms": float(np.mean(self.queue_waits)) * 1000.0,
+                }
+            )
+        return summary
+
+
+class InferenceServer(object):
+    """HTTP/1.1 with keep-alive on asyncio streams.
+
+    POST /predict takes an encoded image as the body and returns its
+    Pawpularity, GET /metrics returns ServeMetrics.summary().
+    """
+
+    def __init__(self, c, ensemble):
+        s = c.serve
+        self.ensemble = ensemble
+        self.metrics = ServeMetrics(s.metrics_window)
+        self.batcher = MicroBatcher(
+            ensemble.predict, s.max_batch_size, s.max_wait_ms, self.metrics
+        )
+        self.preprocess_pool = ThreadPoolExecutor(max_workers=s.n_preprocess_threads)
+        self.log_interval = s.log_interval
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                try:
+                    method, path, headers = parse_head(head)
+                    length = int(headers.get("content-length", 0))
+                    if length < 0:
+                        raise ValueError(f"Invalid Content-Length: {length}")
+                except ValueError as e:
+                    # The rest of the stream can not be framed, so close it.
+                    self.metrics.n_errors += 1
+                    await respond(writer, 400, {"error": str(e)})
+                    break
+                body = await reader.readexactly(length)
+
+                status, payload = await self.route(method, path, body)
+                await respond(writer, status, payload)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if method == "POST" and path == "/predict":
+            start = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            try:
+                views = await loop.run_in_executor(
+                    self.preprocess_pool, self.ensemble.preprocess, body
+                )
+                pred = await self.batcher.submit(views)
+            except ValueError as e:
+                self.metrics.n_errors += 1
+                return 400, {"error": str(e)}
+            except Exception as e:
+                self.metrics.n_errors += 1
+                return 500, {"error": str(e)}
+            self.metrics.update(time.perf_counter() - start)
+            return 200, {"Pawpularity": pred}
+        elif method == "GET" and path == "/metrics":
+            return 200, self.metrics.summary()
+        elif method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+
+        else:
+            return 404, {"error": f"Not found: {method} {path}"}
+
+    async def log_metrics(self):
+        n_requests = 0
+        while True:
+            await asyncio.sleep(self.log_interval)
+            if self.metrics.n_requests > n_requests:
+                n_requests = self.metrics.n_requests
+                log.info(f"metrics: {json.dumps(self.metrics.summary())}")
+
+
+def parse_head(head):
+    """Returns the method, path and lower-cased headers of a request head."""
+    lines = head.decode("latin-1").split("\r\n")
+    parts = lines[0].split(" ")
+    if len(parts) != 3:
+        raise ValueError(f"Invalid request line: {lines[0]!r}")
+    method, path, _ = parts
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            key, value = line.split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+    return method, path, headers
+
+
+async def respond(writer, status, payload):
+    data = json.dumps(payload).encode()
+    writer.write(
+        f"HTTP/1.1 {status} {STATUS[status]}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+    )
+    await writer.drain()
+
+
+async def serve(c, ensemble):
+    # The first forwards allocate and, with torch.compile, compile.
+    views = [
+        torch.zeros(3, bc.params.size, bc.params.size, dtype=torch.float32)
+        for bc in ensemble.configs
+    ]
+    for batch_size in sorted({1, c.serve.max_batch_size}):
+        ensemble.predict([views] * batch_size)
+
+    server = InferenceServer(c, ensemble)
+    tasks = [
+        asyncio.create_task(server.batcher.run()),
+        asyncio.create_task(server.log_metrics()),
+    ]
+    tcp_server = await asyncio.start_server(server.handle, c.serve.host, c.serve.port)
+    log.info(f"Serving on http://{c.serve.host}:{c.serve.port}")
+    try:
+        async with tcp_server:
+            await tcp_server.serve_forever()
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,196 @@
+import copy
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import optuna
+from omegaconf import OmegaConf
+
+from .make_fold import make_fold
+from .make_pipeline import make_pipeline
+from .train_fold import train_fold
+from .train_parallel import assign_device, setup_worker_logging
+from .utils import seed_torch
+
+log = logging.getLogger("__main__").getChild("sweep")
+
+
+def run_sweep(c, train, sweeper, device):
+    """Runs an Optuna study whose trials report every epoch to a pruner.
+
+    sweeper is the hydra optuna sweeper config, which defines the study name,
+    direction and search space. Trials are trained at the fidelity of
+    c.sweep.fidelity, and spread over c.sweep.n_workers devices or CPU slices.
+    """
+    storage = c.sweep.storage or f"sqlite:///{os.path.abspath('sweep.db')}"
+    study = optuna.create_study(
+        study_name=sweeper.study_name,
+        storage=storage,
+        direction=sweeper.direction,
+        load_if_exists=True,
+    )
+
+    c_dict = OmegaConf.to_container(c, resolve=True)
+    search_space = OmegaConf.to_container(sweeper.search_space, resolve=True)
+    n_workers = c.sweep.n_workers
+    n_trials = [len(range(n, c.sweep.n_trials, n_workers)) for n in range(n_workers)]
+
+    if n_workers == 1:
+        _optimize(
+            c_dict,
+            train,
+            search_space,
+            storage,
+            study.study_name,
+            n_trials[0],
+            0,
+            device,
+        )
+    else:
+        log.info(f"Sweep with {n_workers} workers.")
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as executor:
+            futures = [
+                executor.submit(
+                    _run_worker,
+                    slot,
+                    n_workers,
+                    c_dict,
+                    train,
+                    search_space,
+                    storage,
+                    study.study_name,
+                    n_trials[slot],
+                )
+                for slot in range(n_workers)
+            ]
+            for future in futures:
+                future.result()
+
+    return optuna.load_study(study_name=study.study_name, storage=storage)
+
+
+def make_pruner(c):
+    pruner = c.sweep.pruner
+    max_resource = c.sweep.fidelity.n_fold * c.sweep.fidelity.epoch
+
+    if pruner.type == "hyperband":
+        return optuna.pruners.HyperbandPruner(
+            min_resource=pruner.min_resource,
+            max_resource=max_resource,
+            reduction_factor=pruner.reduction_factor,
+        )
+    elif pruner.type == "successive_halving":
+        return optuna.pruners.SuccessiveHalvingPruner(
+            min_resource=pruner.min_resource,
+            reduction_factor=pruner.reduction_factor,
+        )
+    elif pruner.type == "median":
+        return optuna.pruners.MedianPruner(n_warmup_steps=pruner.min_resource)
+    elif pruner.type == "none":
+        return optuna.pruners.NopPruner()
+
+    else:
+        raise Exception("Invalid pruner.")
+
+
+def suggest(trial, search_space):
+    """Samples the overrides of one trial from a hydra optuna sweeper space."""
+    params = {}
+    for key, space in search_space.items():
+        if space["type"] == "float":
+            params[key] = trial.suggest_float(
+                key,
+                space["low"],
+                space["high"],
+                step=space.get("step"),
+                log=space.get("log", False),
+            )
+        elif space["type"] == "int":
+            params[key] = trial.suggest_int(
+                key,
+                space["low"],
+                space["high"],
+                step=space.get("step", 1),
+                log=space.get("log", False),
+            )
+        elif space["type"] == "categorical":
+            params[key] = trial.suggest_categorical(key, space["choices"])
+
+        else:
+            raise Exception("Invalid search space.")
+    return params
+
+
+def apply_fidelity(c, train):
+    """Returns the config and train data that a trial is trained with."""
+    fidelity = c.sweep.fidelity
+    c.params.epoch = fidelity.epoch
+    c.params.size = fidelity.size
+    c.settings.image_cache.size = fidelity.size
+
+    if fidelity.fraction < 1.0:
+        train = train.sample(frac=fidelity.fraction, random_state=c.params.seed)
+        train = train.reset_index(drop=True)
+    train = make_fold(c, train)
+    return c, train
+
+
+def _run_worker(slot, n_workers, *args):
+    # Fork DataLoader workers as the main process does, not spawn.
+    multiprocessing.set_start_method(None, force=True)
+    device = assign_device(slot, n_workers)
+    setup_worker_logging(f"worker{slot}")
+    _optimize(*args, slot, device)
+
+
+def _optimize(c_dict, train, search_space, storage, study_name, n_trials, slot, device):
+    # The storage only keeps the trials, each worker brings sampler and pruner.
+    c = OmegaConf.create(c_dict)
+    study = optuna.load_study(
+        study_name=study_name,
+        storage=storage,
+        sampler=optuna.samplers.TPESampler(seed=c.params.seed + slot),
+        pruner=make_pruner(c),
+    )
+
+    def objective(trial):
+        return _run_trial(c_dict, train, search_space, trial, device)
+
+    study.optimize(objective, n_trials=n_trials)
+
+
+def _run_trial(c_dict, train, search_space, trial, device):
+    c = OmegaConf.create(copy.deepcopy(c_dict))
+    for key, value in suggest(trial, search_space).items():
+        OmegaConf.update(c, key, value)
+    # Only the sweep reports, and trials do not need to be resumed.
+    c.settings.multi_gpu = False
+    c.settings.save_state = False
+    c.mlflow.enabled = False
+    c.wandb.enabled = False
+    c, train = apply_fidelity(c, train.copy())
+
+    log.info(f"========== trial {trial.number}: {trial.params} ==========")
+
+    # Checkpoints of trials running at the same time must not collide.
+    cwd = os.getcwd()
+    os.makedirs(f"trial{trial.number}", exist_ok=True)
+    os.chdir(f"trial{trial.number}")
+    try:
+        pipeline = make_pipeline(c, train, device)
+        scores = []
+        for fold in range(c.sweep.fidelity.n_fold):
+            seed_torch(c.params.seed + fold)
+            _, score, _ = train_fold(
+                c, train, fold, device, pipeline=pipeline, trial=trial
+            )
+            scores.append(score)
+    finally:
+        os.chdir(cwd)
+
+    score = float(np.mean(scores))
+    log.info(f"trial {trial.number}: score {score:.5f}")
+    return score
@@ -1,44 +1,94 @@
+import contextlib
 import logging
 import time
 import warnings
 
-import numpy as np
 import torch
-import torch.cuda.amp as amp
 
-from .utils import AverageMeter, compute_grad_norm, timeSince
+from .make_augment import predict_tta, progressive_size, resize_batch
+from .utils import (
+    DeviceAverageMeter,
+    StageTimer,
+    all_gather_predictions,
+    all_reduce_average,
+    autocast,
+    compute_grad_norm,
+    is_distributed,
+    peak_memory_mb,
+    reset_peak_memory,
+    timeSince,
+)
 
 log = logging.getLogger("__main__").getChild("train_epoch")
 
 
 def train_epoch(
-    c, train_loader, model, criterion, optimizer, scheduler, scaler, epoch, device
+    c,
+    train_loader,
+    model,
+    criterion,
+    optimizer,
+    scheduler,
+    scaler,
+    epoch,
+    device,
+    batch_augment=None,
+    timer=None,
+    profiler=None,
 ):
-    losses = AverageMeter()
+    losses = DeviceAverageMeter(device)
+    timer = timer or StageTimer()
 
     # switch to train mode
     model.train()
     start = time.time()
     optimizer.zero_grad(set_to_none=True)
 
+    reset_peak_memory(device)
+    timer.start()
     for step, (images, features, labels) in enumerate(train_loader):
-        images = images.to(device)
-        features = features.to(device)
-        labels = labels.to(device)
+        timer.lap("wait")
+        images = images.to(device, non_blocking=True)
+        features = features.to(device, non_blocking=True)
+        labels = labels.to(device, non_blocking=True)
         batch_size = labels.size(0)
-
-        with amp.autocast(enabled=c.settings.amp):
-            # y_preds = model(images, features)
-            y_preds = model(images, features).squeeze(1)
-
-            loss = criterion(y_preds, labels)
-
-            losses.update(loss.item(), batch_size)
-            loss = loss / c.params.gradient_acc_step
-
-        scaler.scale(loss).backward()
-
-        if (step + 1) % c.params.gradient_acc_step == 0:
+        timer.lap("transfer")
+
+        if batch_augment is not None:
+            images = batch_augment(images)
+            timer.lap("augment")
+
+        size = progressive_size(c, epoch, step, len(train_loader))
+        if size != images.size(-1):
+            images = resize_batch(images, size)
+            timer.lap("resize")
+
+        update = (step + 1) % c.params.gradient_acc_step == 0
+        print_step = step % c.settings.print_freq == 0 or step == (
+            len(train_loader) - 1
+        )
+
+        # DDP only needs to all-reduce gradients on the step that updates weights.
+        with (
+            model.no_sync()
+            if is_distributed() and not update
+            else contextlib.nullcontext()
+        ):
+            with autocast(device.type, c.settings.amp, c.settings.execution.cpu_dtype):
+                # y_preds = model(images, features)
+                y_preds = model(images, features).squeeze(1)
+                timer.lap("forward")
+
+                loss = criterion(y_preds, labels)
+
+                losses.update(loss, batch_size)
+                loss = loss / c.params.gradient_acc_step
+                timer.lap("loss")
+
+            scaler.scale(loss).backward()
+            timer.lap("backward")
+
+        if update:
             scaler.unscale_(optimizer)
 
             # error_if_nonfinite に関する warning を抑止する
@@ -53,48 +103,72 @@ def train_epoch(
             scaler.update()
 
             optimizer.zero_grad(set_to_none=True)
+            timer.lap("optimizer")
+
             scheduler.step()
-        else:
+            timer.lap("scheduler")
+        elif print_step:
+            # Only needed for the log line.
             grad_norm = compute_grad_norm(model.parameters())
 
         # end = time.time()
-        if step % c.settings.print_freq == 0 or step == (len(train_loader) - 1):
+        if print_step:
+            # Only CUDA has a peak that is reset per log line.
+            mem = peak_memory_mb(device)
+            mem = f"Mem: {mem:.0f}MB " if mem is not None else ""
             log.info(
                 f"Epoch: [{epoch + 1}][{step}/{len(train_loader)}] "
                 f"Elapsed {timeSince(start, float(step + 1) / len(train_loader)):s} "
                 f"Loss: {losses.avg:.4f} "
                 f"Grad: {grad_norm:.4f} "
+                f"Size: {size} "
+                f"{mem}"
                 f"LR: {scheduler.get_last_lr()[0]:.2e}  "
                 # f"LR: {scheduler.get_lr()[0]:.2e}  "
             )
+            # Peak of the steps up to the next log line.
+            reset_peak_memory(device)
+
+        if profiler is not None:
+            profiler.step()
+        timer.start()
 
     return losses.avg
 
 
-def validate_epoch(c, valid_loader, model, criterion, device):
-    losses = AverageMeter()
+def validate_epoch(c, valid_loader, model, criterion, device, timer=None):
+    losses = DeviceAverageMeter(device)
+    timer = timer or StageTimer()
 
     # switch to evaluation mode
     model.eval()
-    preds = []
+    # Predictions stay on device until the end of the epoch.
+    # len(sampler) is the number of samples of this rank with DDP.
+    preds = torch.empty(len(valid_loader.sampler), device=device)
     start = time.time()
 
+    timer.start()
     for step, (images, features, labels) in enumerate(valid_loader):
-        images = images.to(device)
-        features = features.to(device)
-        labels = labels.to(device)
+        timer.lap("wait")
+        images = images.to(device, non_blocking=True)
+        features = features.to(device, non_blocking=True)
+        labels = labels.to(device, non_blocking=True)
         batch_size = labels.size(0)
+        start_idx = step * valid_loader.batch_size
+        timer.lap("transfer")
 
         # with torch.no_grad():
         with torch.inference_mode():
             # y_preds = model(images, features)
-            y_preds = model(images, features).squeeze(1)
+            y_preds = predict_tta(model, images, features, c.params.tta).squeeze(1)
+        timer.lap("forward")
 
         loss = criterion(y_preds, labels)
-        losses.update(loss.item(), batch_size)
+        losses.update(loss, batch_size)
 
         # preds.append(y_preds.softmax(1).to("cpu").numpy())
-        preds.append(y_preds.to("cpu").numpy())
+        preds[start_idx : start_idx + batch_size] = y_preds
+        timer.lap("loss")
 
         # end = time.time()
         if step % c.settings.print_freq == 0 or step == (len(valid_loader) - 1):
@@ -104,5 +178,11 @@ def validate_epoch(c, valid_loader, model, criterion, device):
                 f"Loss: {losses.avg:.4f} "
             )
 
-    predictions = np.concatenate(preds)
-    return losses.avg, predictions
+        timer.start()
+
+    if is_distributed():
+        # FoldSampler only yields the rows of the fold out of the whole dataset.
+        n_data = getattr(valid_loader.sampler, "n_data", len(valid_loader.dataset))
+        predictions = all_gather_predictions(preds, n_data)
+        return all_reduce_average(losses), predictions
+    return losses.avg, preds.cpu().numpy()
@@ -1,37 +1,52 @@
+import contextlib
 import logging
+import os
 import time
 
 import mlflow
 import numpy as np
+import optuna
 import torch.cuda.amp as amp
 
 import wandb
 
 from .get_score import get_score
-from .make_dataset import make_dataloader, make_dataset
+from .make_augment import make_batch_augment
 from .make_loss import make_criterion, make_optimizer, make_scheduler
 from .make_model import make_model
+from .make_pipeline import make_pipeline
 from .train_epoch import train_epoch, validate_epoch
-from .utils import EarlyStopping
+from .utils import (
+    EarlyStopping,
+    StageTimer,
+    get_rng_state,
+    is_main_process,
+    load_checkpoint,
+    make_profiler,
+    save_checkpoint,
+    set_rng_state,
+)
 
 log = logging.getLogger("__main__").getChild("train_loop")
 
 
-def train_fold(c, df, fold, device):
+def train_fold(c, df, fold, device, writer=None, pipeline=None, trial=None):
     # ====================================================
     # Data Loader
     # ====================================================
-    trn_idx = df[df["fold"] != fold].index
     val_idx = df[df["fold"] == fold].index
 
-    train_folds = df.loc[trn_idx].reset_index(drop=True)
     valid_folds = df.loc[val_idx].reset_index(drop=True)
 
-    train_ds = make_dataset(c, train_folds, "train")
-    valid_ds = make_dataset(c, valid_folds, "valid")
+    if pipeline is None or not pipeline.serves(fold):
+        pipeline = make_pipeline(c, df, device, fold)
+    pipeline.set_fold(fold)
+    train_loader = pipeline.train_loader
+    valid_loader = pipeline.valid_loader
 
-    train_loader = make_dataloader(c, train_ds, shuffle=True, drop_last=True)
-    valid_loader = make_dataloader(c, valid_ds, shuffle=False, drop_last=False)
+    batch_augment = make_batch_augment(c)
+    if batch_augment is not None:
+        batch_augment.to(device)
 
     # ====================================================
     # Model
@@ -41,37 +56,72 @@ def train_fold(c, df, fold, device):
 
     criterion = make_criterion(c)
     optimizer = make_optimizer(c, model)
-    scaler = amp.GradScaler(enabled=c.settings.amp)
-    scheduler = make_scheduler(c, optimizer, train_ds)
+    # bfloat16 autocast on CPU does not need loss scaling.
+    scaler = amp.GradScaler(enabled=c.settings.amp and device.type == "cuda")
+    # Rows this process trains on per epoch, a 1/world_size shard with DDP.
+    scheduler = make_scheduler(c, optimizer, train_loader.sampler)
 
     es = EarlyStopping(
         patience=c.params.es_patience,
         verbose=True,
         path=f"{c.params.model_name.replace('/', '-')}_fold{fold}",
         mlflow=c.mlflow.enabled,
+        writer=writer,
     )
 
+    # ====================================================
+    # Resume
+    # ====================================================
+    start_epoch = 0
+    state_path = f"fold{fold}_state.pth"
+    if c.settings.resume and os.path.exists(state_path):
+        state = load_checkpoint(state_path)
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        scheduler.load_state_dict(state["scheduler"])
+        scaler.load_state_dict(state["scaler"])
+        es.load_state_dict(state["es"])
+        set_rng_state(state["rng"])
+
+        start_epoch = c.params.epoch if es.early_stop else state["epoch"] + 1
+        log.info(f"Resume fold {fold} from epoch {start_epoch + 1}")
+
     # ====================================================
     # Loop
     # ====================================================
-    for epoch in range(c.params.epoch):
+    for epoch in range(start_epoch, c.params.epoch):
         start_time = time.time()
 
+        pipeline.set_epoch(epoch)
+
+        timing = c.settings.timing
+        train_timer = StageTimer(timing.enabled, timing.sync, device)
+        valid_timer = StageTimer(timing.enabled, timing.sync, device)
+        profiler = None
+        if c.settings.profiler.enabled and epoch == start_epoch:
+            profiler = make_profiler(c, f"trace_fold{fold}_epoch{epoch + 1}")
+
         # train
-        avg_loss = train_epoch(
-            c,
-            train_loader,
-            model,
-            criterion,
-            optimizer,
-            scheduler,
-            scaler,
-            epoch,
-            device,
-        )
+        with profiler or contextlib.nullcontext():
+            avg_loss = train_epoch(
+                c,
+                train_loader,
+                model,
+                criterion,
+                optimizer,
+                scheduler,
+                scaler,
+                epoch,
+                device,
+                batch_augment,
+                train_timer,
+                profiler,
+            )
 
         # eval
-        avg_val_loss, preds = validate_epoch(c, valid_loader, model, criterion, device)
+        avg_val_loss, preds = validate_epoch(
+            c, valid_loader, model, criterion, device, valid_timer
+        )
         valid_labels = valid_folds["Pawpularity"].values
 
         if "WithLogitsLoss" in c.params.criterion:
@@ -110,8 +160,31 @@ def train_fold(c, df, fold, device):
                 }
             )
 
+        if c.settings.timing.enabled:
+            log_stage_times(c, train_timer, "train", fold, epoch)
+            log_stage_times(c, valid_timer, "valid", fold, epoch)
+
         es(avg_val_loss, score, model, preds)
 
+        # Lets the pruner of a sweep stop this trial at any epoch of any fold.
+        if trial is not None:
+            trial.report(score, fold * c.params.epoch + epoch)
+            if trial.should_prune():
+                raise optuna.TrialPruned()
+
+        if c.settings.save_state and is_main_process():
+            state = {
+                "fold": fold,
+                "epoch": epoch,
+                "model": model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "scheduler": scheduler.state_dict(),
+                "scaler": scaler.state_dict(),
+                "es": es.state_dict(),
+                "rng": get_rng_state(),
+            }
+            save_checkpoint(state, state_path, writer)
+
         if es.early_stop:
             log.info("Early stopping")
             break
@@ -120,4 +193,49 @@ def train_fold(c, df, fold, device):
     # valid_folds["preds"] = es.best_preds.argmax(1)
     valid_folds["preds"] = es.best_preds
 
+    if "teacher" in valid_folds.columns:
+        teacher_score = get_score(valid_labels, valid_folds["teacher"].values)
+        log.info(
+            f"Teacher score: {teacher_score:.4f} "
+            f"gap: {es.best_score - teacher_score:+.4f}"
+        )
+
     return valid_folds, es.best_score, es.best_loss
+
+
+def log_stage_times(c, timer, name, fold, epoch):
+    summary = timer.summary()
+    for stage, t in summary.items():
+        log.info(
+            f"Time {name} {stage:<9s} - "
+            f"p50: {t['p50']:.1f}ms p90: {t['p90']:.1f}ms p99: {t['p99']:.1f}ms "
+            f"total: {t['total']:.1f}s ({t['share'] * 100:.0f}%)"
+        )
+
+    wait = summary.get("wait", {"share": 0.0})["share"]
+    if wait > c.settings.timing.starvation:
+        log.warning(
+            f"Dataloader starvation: {name} waits for batches "
+            f"{wait * 100:.0f}% of the time."
+        )
+
+    if c.mlflow.enabled:
+        mlflow.log_metrics(
+            {
+                f"time_{name}_{stage}_{p}_{fold}": t[p]
+                for stage, t in summary.items()
+                for p in ["p50", "p99"]
+            },
+            step=epoch,
+        )
+    if c.wandb.enabled:
+        wandb.log(
+            {
+                "epoch": epoch + 1,
+                **{
+                    f"time/{name}_{stage}_{p}_fold{fold}": t[p]
+                    for stage, t in summary.items()
+                    for p in ["p50", "p99"]
+                },
+            }
+        )
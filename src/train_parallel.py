@@ -0,0 +1,105 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from omegaconf import OmegaConf
+
+from .make_pipeline import make_pipeline
+from .train_fold import train_fold
+from .utils import CheckpointWriter, seed_torch
+
+log = logging.getLogger("__main__").getChild("train_parallel")
+
+_device = None
+_pipeline = None
+
+
+def train_folds_parallel(c, df, folds):
+    """Runs train_fold for independent folds concurrently in a process pool.
+
+    Each worker owns one device, or a slice of the CPU cores when there is no
+    GPU. Returns the train_fold results in the order of folds.
+    """
+    n_workers = min(c.settings.fold_workers, len(folds))
+    log.info(f"Training {len(folds)} folds with {n_workers} workers.")
+
+    # Workers can not resolve hydra interpolations, so pass a resolved copy.
+    c_dict = OmegaConf.to_container(c, resolve=True)
+
+    ctx = multiprocessing.get_context("spawn")
+    slots = ctx.Queue()
+    for slot in range(n_workers):
+        slots.put(slot)
+
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=ctx,
+        initializer=_init_worker,
+        initargs=(slots, n_workers),
+    ) as executor:
+        futures = [executor.submit(_train_fold, c_dict, df, fold) for fold in folds]
+        return [future.result() for future in futures]
+
+
+def _init_worker(slots, n_workers):
+    global _device
+    # Fork DataLoader workers as the main process does, not spawn.
+    multiprocessing.set_start_method(None, force=True)
+    _device = assign_device(slots.get(), n_workers)
+
+
+def assign_device(slot, n_workers):
+    """Gives worker slot one GPU, or its share of the CPU cores without GPUs."""
+    if torch.cuda.is_available():
+        device = torch.device(f"cuda:{slot % torch.cuda.device_count()}")
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device("cpu")
+        cpus = sorted(os.sched_getaffinity(0))
+        n_cpus = max(1, len(cpus) // n_workers)
+        cpus = cpus[slot * n_cpus : (slot + 1) * n_cpus] or cpus
+        os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(len(cpus))
+    return device
+
+
+def _train_fold(c_dict, df, fold):
+    c = OmegaConf.create(c_dict)
+    # One device per worker, and per-epoch metrics only go to the fold log.
+    # The parent process reports the fold results to mlflow / wandb.
+    c.settings.multi_gpu = False
+    c.mlflow.enabled = False
+    c.wandb.enabled = False
+
+    setup_worker_logging(f"fold{fold}")
+    log.info(f"========== fold {fold} training on {_device} ==========")
+
+    # A worker trains several folds when there are more folds than workers.
+    global _pipeline
+    if _pipeline is None or not _pipeline.serves(fold):
+        _pipeline = make_pipeline(c, df, _device, fold)
+
+    seed_torch(c.params.seed + fold)
+    writer = CheckpointWriter()
+    try:
+        return train_fold(c, df, fold, _device, writer, _pipeline)
+    finally:
+        writer.close()
+
+
+def setup_worker_logging(name):
+    formatter = logging.Formatter(f"[{name}][%(levelname)s][%(name)s] - %(message)s")
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+
+    for handler in [
+        logging.StreamHandler(),
+        logging.FileHandler(f"train_{name}.log"),
+    ]:
+        handler.setFormatter(formatter)
+        root.addHandler(handler)
+    root.setLevel(logging.INFO)
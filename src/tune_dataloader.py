@@ -0,0 +1,219 @@
+import copy
+import hashlib
+import itertools
+import json
+import logging
+import os
+import platform
+import time
+
+import torch
+import torch.distributed as dist
+from omegaconf import OmegaConf
+
+from .make_dataset import make_dataloader
+from .make_model import BaseModel
+from .utils import autocast, is_distributed, is_main_process, sync
+
+log = logging.getLogger("__main__").getChild("tune_dataloader")
+
+
+def tune_dataloader(c, train_ds, valid_ds, device):
+    """Returns c with settings.dataloader tuned for this machine and dataset.
+
+    Sweeps the candidates of settings.dataloader.autotune and keeps the loader
+    settings with the shortest estimated epoch, where the loader is only as
+    fast as the model can consume batches. The validation batch size is the
+    fastest one for inference. The choice is cached per host and config.
+    """
+    if not c.settings.dataloader.autotune.enabled:
+        return c
+
+    path = os.path.join(
+        c.settings.dirs.cache,
+        "dataloader",
+        f"{platform.node()}_{tuning_key(c, device)}.json",
+    )
+
+    tuned = None
+    if is_main_process():
+        if os.path.exists(path):
+            log.info(f"Using dataloader tuning cache: {path}")
+            with open(path) as f:
+                tuned = json.load(f)
+        else:
+            tuned = _tune(c, train_ds, valid_ds, device)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(tuned, f, indent=2)
+            os.replace(tmp_path, path)
+
+    if is_distributed():
+        objects = [tuned]
+        dist.broadcast_object_list(objects, src=0)
+        tuned = objects[0]
+
+    log.info(f"Dataloader settings: {tuned}")
+    c = copy.deepcopy(c)
+    c.settings.dataloader = OmegaConf.merge(c.settings.dataloader, tuned)
+    return c
+
+
+def tuning_key(c, device):
+    key = {
+        "params": {
+            k: c.params[k]
+            for k in ["model_name", "size", "batch_size", "batch_augment"]
+        },
+        "image_cache": c.settings.image_cache.enabled,
+        "amp": c.settings.amp,
+        "autotune": OmegaConf.to_container(c.settings.dataloader.autotune),
+        "debug": c.settings.debug,
+        "n_cpu": len(os.sched_getaffinity(0)),
+        "device": device.type,
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:8]
+
+
+def _tune(c, train_ds, valid_ds, device):
+    at = c.settings.dataloader.autotune
+    # One batch starts the workers, and at least one more is timed.
+    if len(train_ds) // c.params.batch_size < 2:
+        log.warning("Too few train batches to tune the dataloader, keep its settings.")
+        return {}
+
+    model = BaseModel(c, pretrained=False).to(device)
+
+    n_features = train_ds.features.shape[1]
+    model_rate = measure_model(c, model, n_features, device, at.n_batches)
+    log.info(f"Model consumes {model_rate:.1f} images/s")
+
+    n_cpu = len(os.sched_getaffinity(0))
+    candidates = []
+    for num_workers, prefetch_factor, persistent_workers in itertools.product(
+        sorted(at.num_workers), at.prefetch_factor, at.persistent_workers
+    ):
+        if num_workers > n_cpu:
+            continue
+        # Without workers, prefetch and persistence do not apply.
+        candidate = {
+            "num_workers": num_workers,
+            "prefetch_factor": prefetch_factor if num_workers > 0 else 2,
+            "persistent_workers": persistent_workers and num_workers > 0,
+        }
+        if candidate not in candidates:
+            candidates.append(candidate)
+
+    best, best_time, best_rate = None, float("inf"), 0.0
+    for candidate in candidates:
+        tc = with_dataloader(c, candidate)
+        startup, rate = measure_loader(tc, train_ds, at.n_batches)
+
+        # Non-persistent workers are started again for every epoch.
+        n_batches = len(train_ds) // c.params.batch_size
+        epoch_time = (0.0 if candidate["persistent_workers"] else startup) + (
+            n_batches * c.params.batch_size / min(rate, model_rate)
+        )
+        log.info(
+            f"{candidate} - startup: {startup:.2f}s loader: {rate:.1f} images/s "
+            f"epoch: {epoch_time:.1f}s"
+        )
+        # Fewer workers come first, so they win unless clearly faster.
+        if epoch_time < best_time * 0.95:
+            best, best_time, best_rate = candidate, epoch_time, rate
+
+    if best_rate < model_rate:
+        log.warning(
+            f"Dataloader starves the model even with {best}: "
+            f"{best_rate:.1f} < {model_rate:.1f} images/s"
+        )
+
+    # A few of the largest batches are enough to compare batch sizes.
+    n_valid = min(len(valid_ds), max(at.valid_batch_size) * 2)
+    valid_ds = torch.utils.data.Subset(valid_ds, range(n_valid))
+
+    best_rate, best["valid_batch_size"] = 0.0, c.params.batch_size
+    model.eval()
+    for batch_size in sorted(at.valid_batch_size):
+        tc = with_dataloader(c, best)
+        try:
+            rate = measure_inference(tc, model, valid_ds, batch_size, device)
+        except torch.cuda.OutOfMemoryError:
+            log.info(f"valid_batch_size: {batch_size} - out of memory")
+            torch.cuda.empty_cache()
+            break
+        log.info(f"valid_batch_size: {batch_size} - {rate:.1f} images/s")
+        if rate > best_rate * 1.05:
+            best_rate, best["valid_batch_size"] = rate, batch_size
+
+    del model
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+    return best
+
+
+def with_dataloader(c, settings):
+    c = copy.deepcopy(c)
+    c.settings.dataloader = OmegaConf.merge(c.settings.dataloader, settings)
+    return c
+
+
+def measure_model(c, model, n_features, device, n_batches):
+    """Images/s of a training forward and backward pass on random inputs."""
+    model.train()
+    images = torch.randn(
+        c.params.batch_size, 3, c.params.size, c.params.size, device=device
+    )
+    features = torch.randn(c.params.batch_size, n_features, device=device)
+
+    def step():
+        with autocast(device.type, c.settings.amp, c.settings.execution.cpu_dtype):
+            y = model(images, features)
+        y.float().mean().backward()
+
+    step()
+    sync(device)
+    start = time.perf_counter()
+    for _ in range(n_batches):
+        step()
+    sync(device)
+    model.zero_grad(set_to_none=True)
+    return n_batches * c.params.batch_size / (time.perf_counter() - start)
+
+
+def measure_loader(c, ds, n_batches):
+    """Returns seconds to the first batch and images/s after it."""
+    loader = make_dataloader(c, ds, shuffle=True, drop_last=True)
+    n_batches = min(n_batches, len(loader) - 1)
+    if n_batches < 1:
+        raise Exception("Invalid dataset, no batch to time after the first.")
+
+    start = time.perf_counter()
+    it = iter(loader)
+    next(it)
+    startup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    n = 0
+    for images, _, _ in itertools.islice(it, n_batches):
+        n += len(images)
+    rate = n / max(time.perf_counter() - start, 1e-6)
+    del it, loader
+    return startup, rate
+
+
+def measure_inference(c, model, ds, batch_size, device):
+    loader = make_dataloader(
+        c, ds, shuffle=False, drop_last=False, batch_size=batch_size
+    )
+
+    n = 0
+    with torch.inference_mode():
+        start = time.perf_counter()
+        for images, features, _ in loader:
+            with autocast(device.type, c.settings.amp, c.settings.execution.cpu_dtype):
+                model(images.to(device), features.to(device))
+            n += len(images)
+        sync(device)
+    return n / (time.perf_counter() - start)
@@ -1,8 +1,11 @@
+import copy
 import json
 import logging
 import math
 import os
+import queue
 import random
+import threading
 import time
 
 import git
@@ -11,6 +14,7 @@ import numpy as np
 import pkg_resources as pr
 import requests
 import torch
+import torch.distributed as dist
 from omegaconf import DictConfig, ListConfig, OmegaConf
 from omegaconf.errors import ConfigAttributeError
 
@@ -48,11 +52,151 @@ def gpu_settings(c):
     except ConfigAttributeError:
         pass
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    log.info(f"torch device: {device}")
+    # Launched with torchrun
+    if "LOCAL_RANK" in os.environ:
+        device = ddp_settings(c)
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        log.info(f"torch device: {device}")
+
+    backend_settings(c)
     return device
 
 
+def backend_settings(c):
+    e = c.settings.execution
+    if e.n_threads > 0:
+        torch.set_num_threads(e.n_threads)
+    if e.n_interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(e.n_interop_threads)
+        except RuntimeError:
+            log.warning("Inter-op threads can only be set before parallel work.")
+    log.info(
+        f"torch threads: {torch.get_num_threads()} "
+        f"interop: {torch.get_num_interop_threads()}"
+    )
+
+    torch.backends.cudnn.benchmark = e.cudnn_benchmark
+    # Changes the float32 numerics, so the torch defaults are kept unless set.
+    if e.tf32:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
+
+    if e.compile:
+        # Only runs that compile pay for importing inductor.
+        from torch._inductor import config as inductor_config
+
+        # Compiled graphs are cached on disk, so later folds and runs reuse them.
+        os.environ.setdefault(
+            "TORCHINDUCTOR_CACHE_DIR", os.path.join(c.settings.dirs.cache, "inductor")
+        )
+        inductor_config.fx_graph_cache = True
+
+
+def autocast(device_type, enabled, cpu_dtype=None):
+    """Mixed precision, float16 on CUDA and cpu_dtype on CPU.
+
+    CPU stays in float32 without cpu_dtype, like torch.cuda.amp.autocast.
+    """
+    if device_type == "cuda":
+        return torch.autocast(device_type, dtype=torch.float16, enabled=enabled)
+    enabled = enabled and cpu_dtype is not None
+    dtype = getattr(torch, cpu_dtype) if enabled else None
+    return torch.autocast(device_type, dtype=dtype, enabled=enabled)
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def reset_peak_memory(device):
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_mb(device):
+    """Peak allocated memory since reset_peak_memory on CUDA, None on CPU.
+
+    The peak RSS of a process can not be reset, so there is no per-step peak
+    on CPU.
+    """
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return None
+
+
+def ddp_settings(c):
+    local_rank = int(os.environ["LOCAL_RANK"])
+    if torch.cuda.is_available():
+        device = torch.device(f"cuda:{local_rank}")
+        torch.cuda.set_device(device)
+        backend = "nccl"
+    else:
+        device = torch.device("cpu")
+        backend = "gloo"
+
+    dist.init_process_group(backend=backend)
+    log.info(
+        f"DDP rank: {dist.get_rank()}/{dist.get_world_size()}, "
+        f"backend: {backend}, torch device: {device}"
+    )
+
+    # Only rank 0 logs, saves checkpoints and reports to mlflow / wandb.
+    if dist.get_rank() != 0:
+        logging.getLogger().setLevel(logging.WARNING)
+        c.mlflow.enabled = False
+        c.wandb.enabled = False
+    return device
+
+
+def teardown_ddp():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process():
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def _dist_device():
+    if dist.get_backend() == "nccl":
+        return torch.device("cuda", torch.cuda.current_device())
+    return torch.device("cpu")
+
+
+def all_reduce_average(meter):
+    """Returns the average of an AverageMeter over all DDP ranks."""
+    if not is_distributed():
+        return meter.avg
+
+    t = torch.tensor(
+        [float(meter.sum), meter.count], dtype=torch.float64, device=_dist_device()
+    )
+    dist.all_reduce(t)
+    return (t[0] / t[1]).item()
+
+
+def all_gather_predictions(preds, n):
+    """Gathers the predictions of DistributedSampler(shuffle=False) shards back
+    into dataset order, dropping the padded samples."""
+    if not is_distributed():
+        return preds
+
+    t = torch.as_tensor(preds).to(_dist_device())
+    gathered = [torch.empty_like(t) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, t)
+    # Rank r holds samples r, r + world_size, r + 2 * world_size, ...
+    preds = torch.stack(gathered, dim=1).reshape(-1, *t.shape[1:])[:n]
+    return preds.cpu().numpy()
+
+
 class AverageMeter(object):
     """Computes and stores the average and current value"""
 
@@ -72,6 +216,92 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class DeviceAverageMeter(object):
+    """AverageMeter that keeps the running sum on device.
+
+    update takes a tensor and does not wait for the device, only reading avg does.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.sum = torch.zeros((), dtype=torch.float64, device=self.device)
+        self.count = 0
+
+    def update(self, val, n=1):
+        self.sum += val.detach() * n
+        self.count += n
+
+    @property
+    def avg(self):
+        return (self.sum / max(self.count, 1)).item()
+
+
+class StageTimer(object):
+    """Records the wall time of each stage of a loop.
+
+    lap(name) adds the time since the previous lap to name. With sync the device
+    is synchronized first, so that asynchronous kernels are counted in the stage
+    that launched them.
+    """
+
+    def __init__(self, enabled=False, sync=False, device=None):
+        self.enabled = enabled
+        self.sync = sync and device is not None and device.type == "cuda"
+        self.device = device
+        self.times = {}
+        self.last = time.perf_counter()
+
+    def start(self):
+        self.last = time.perf_counter()
+
+    def lap(self, name):
+        if not self.enabled:
+            return
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        now = time.perf_counter()
+        self.times.setdefault(name, []).append(now - self.last)
+        self.last = now
+
+    def summary(self):
+        """Returns {stage: {p50, p90, p99 (ms), total (s), share}}."""
+        total = sum(sum(t) for t in self.times.values())
+        summary = {}
+        for name, t in self.times.items():
+            p50, p90, p99 = np.percentile(t, [50, 90, 99]) * 1000.0
+            summary[name] = {
+                "p50": p50,
+                "p90": p90,
+                "p99": p99,
+                "total": sum(t),
+                "share": sum(t) / total if total > 0 else 0.0,
+            }
+        return summary
+
+
+def make_profiler(c, name):
+    """torch.profiler over a window of steps that writes a Chrome trace to name.json."""
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(
+            wait=c.settings.profiler.wait,
+            warmup=c.settings.profiler.warmup,
+            active=c.settings.profiler.active,
+            repeat=1,
+        ),
+        on_trace_ready=lambda prof: prof.export_chrome_trace(f"{name}.json"),
+        record_shapes=True,
+        profile_memory=True,
+    )
+
+
 def asMinutes(s):
     m = math.floor(s / 60)
     s -= m * 60
@@ -98,7 +328,13 @@ class EarlyStopping:
     """Early stops the training if validation loss doesn't improve after a given patience."""
 
     def __init__(
-        self, patience=7, verbose=False, delta=0, path="checkpoint.pt", mlflow=False
+        self,
+        patience=7,
+        verbose=False,
+        delta=0,
+        path="checkpoint.pt",
+        mlflow=False,
+        writer=None,
     ):
         """
         Args:
@@ -110,6 +346,8 @@ class EarlyStopping:
                             Default: 0
             path (str): Path for the checkpoint to be saved to.
                             Default: 'checkpoint.pt'
+            writer (CheckpointWriter): Saves the checkpoint in the background if given.
+                            Default: None
         """
         self.patience = patience
         self.verbose = verbose
@@ -121,6 +359,7 @@ class EarlyStopping:
         self.path = path
         self.best_preds = None
         self.mlflow = mlflow
+        self.writer = writer
 
     def __call__(self, val_loss, score, model, preds):
 
@@ -153,9 +392,174 @@ class EarlyStopping:
         #         self.path,
         #         pip_requirements=get_torch_version(),
         #     )
-        torch.save(model.state_dict(), f"{self.path}_best.pth")
+        if is_main_process():
+            save_checkpoint(model.state_dict(), f"{self.path}_best.pth", self.writer)
         self.best_loss = val_loss
 
+    def state_dict(self):
+        return {
+            "counter": self.counter,
+            "best_score": self.best_score,
+            "early_stop": self.early_stop,
+            "best_loss": self.best_loss,
+            "best_preds": self.best_preds,
+        }
+
+    def load_state_dict(self, state):
+        self.counter = state["counter"]
+        self.best_score = state["best_score"]
+        self.early_stop = state["early_stop"]
+        self.best_loss = state["best_loss"]
+        self.best_preds = state["best_preds"]
+
+
+class FoldAbort:
+    """Stops the CV loop when the running fold scores show that the config can
+    not beat a reference score, i.e. the lower confidence bound of the mean
+    fold score is still worse than the reference plus margin.
+
+    The reference is the better of threshold and the best CV score of
+    completed runs kept in best_path.
+    """
+
+    def __init__(self, threshold=None, best_path=None, z=2.0, margin=0.0, min_folds=1):
+        self.best_path = best_path
+        self.z = z
+        self.margin = margin
+        self.min_folds = min_folds
+        self.scores = []
+        self.aborted = False
+
+        self.reference = threshold
+        if best_path is not None and os.path.exists(best_path):
+            with open(best_path) as f:
+                best = json.load(f)["score"]
+            if self.reference is None or best < self.reference:
+                self.reference = best
+
+    def __call__(self, score):
+        self.scores.append(score)
+        if self.reference is None or len(self.scores) < self.min_folds:
+            return False
+
+        k = len(self.scores)
+        std = np.std(self.scores, ddof=1) if k > 1 else 0.0
+        bound = self.score - self.z * std / np.sqrt(k)
+        if bound > self.reference + self.margin:
+            log.warning(
+                f"Abort CV: score {self.score:.5f} (bound {bound:.5f}) after {k} folds "
+                f"can not beat {self.reference:.5f}"
+            )
+            self.aborted = True
+        return self.aborted
+
+    @property
+    def score(self):
+        return float(np.mean(self.scores))
+
+    def update_best(self, score):
+        """Records score of a completed run if it is the best so far."""
+        if self.best_path is None:
+            return
+        if self.reference is not None and score >= self.reference:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.best_path)), exist_ok=True)
+        tmp_path = f"{self.best_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"score": score, "dir": os.getcwd()}, f)
+        os.replace(tmp_path, self.best_path)
+
+
+def save_checkpoint(obj, path, writer=None):
+    if writer is not None:
+        writer.save(obj, path)
+    else:
+        _save_atomic(obj, path)
+
+
+def load_checkpoint(path):
+    # Full-state checkpoints hold numpy arrays and DataFrames besides tensors.
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+def _save_atomic(obj, path):
+    tmp_path = f"{path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter:
+    """Saves checkpoints atomically from a background thread.
+
+    Tensors are copied to CPU when save is called, so training can go on while
+    the copy is written. At most maxsize checkpoints wait in the queue.
+    """
+
+    def __init__(self, maxsize=2):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, obj, path):
+        self._raise_error()
+        self.queue.put((_snapshot(obj), path))
+
+    def wait(self):
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                _save_atomic(*item)
+            except Exception as e:
+                log.error(f"Failed to save checkpoint: {e}")
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+
+def _snapshot(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def get_rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if torch.cuda.is_available() and "cuda" in state:
+        torch.cuda.set_rng_state_all(state["cuda"])
+
 
 def compute_grad_norm(parameters, norm_type=2.0):
     """Refer to torch.nn.utils.clip_grad_norm_"""
@@ -164,12 +568,13 @@ def compute_grad_norm(parameters, norm_type=2.0):
     parameters = [p for p in parameters if p.grad is not None]
     norm_type = float(norm_type)
     device = parameters[0].grad.device
-    total_norm = torch.norm(
-        torch.stack(
-            [torch.norm(p.grad.detach(), norm_type).to(device) for p in parameters]
-        ),
-        norm_type,
-    )
+    grads = [p.grad.detach() for p in parameters]
+    if hasattr(torch, "_foreach_norm"):
+        # One fused multi-tensor kernel instead of a norm per parameter
+        norms = torch._foreach_norm(grads, norm_type)
+    else:
+        norms = [torch.norm(g, norm_type) for g in grads]
+    total_norm = torch.norm(torch.stack([n.to(device) for n in norms]), norm_type)
 
     return total_norm
 
@@ -200,16 +605,29 @@ def setup_wandb(c):
         return run
 
 
-def teardown_mlflow(c, loss):
+def teardown_mlflow(c, loss, aborted=False):
     if c.mlflow.enabled:
-        mlflow.log_metric("loss", loss)
+        # Partial results of aborted runs must not look like CV results.
+        if aborted:
+            mlflow.set_tag("aborted", True)
+            mlflow.set_tag("status", "aborted")
+            # Replaces the last fold score as the latest score of the run, at
+            # the step of the final result.
+            mlflow.log_metric("score", float("nan"), c.params.n_fold)
+        else:
+            mlflow.log_metric("loss", loss)
         mlflow.log_artifacts(".")
-        mlflow.end_run()
+        mlflow.end_run(status="KILLED" if aborted else "FINISHED")
 
 
-def teardown_wandb(c, run, loss):
+def teardown_wandb(c, run, loss, aborted=False):
     if c.wandb.enabled:
-        wandb.summary["loss"] = loss
+        if aborted:
+            # The last per-fold score is not the score of the run.
+            wandb.summary["score"] = float("nan")
+            wandb.summary["aborted"] = True
+        else:
+            wandb.summary["loss"] = loss
         if c.wandb.save_artifacts:
             artifact = wandb.Artifact(c.params.model_name, type="model")
             artifact.add_dir(".")
@@ -0,0 +1,36 @@
+import logging
+
+import hydra
+from hydra.core.hydra_config import HydraConfig
+
+import src.utils as utils
+from src.load_data import load_data
+from src.sweep import run_sweep
+
+log = logging.getLogger(__name__)
+
+
+@hydra.main(config_path="config", config_name="main")
+def main(c):
+    log.info("Started.")
+
+    utils.debug_settings(c)
+    device = utils.gpu_settings(c)
+
+    train, test, sub = load_data(c)
+
+    study = run_sweep(c, train, HydraConfig.get().sweeper, device)
+
+    df = study.trials_dataframe()
+    df.to_csv("sweep_trials.csv", index=False)
+    counts = df["state"].value_counts().to_dict()
+    log.info(f"Trials: {counts}")
+    log.info(f"Best trial {study.best_trial.number}: {study.best_value:.5f}")
+    log.info(f"Best params: {study.best_params}")
+
+    log.info("Done.")
+    return study.best_value
+
+
+if __name__ == "__main__":
+    main()
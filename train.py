@@ -1,13 +1,19 @@
+import json
 import logging
+import os
 
 import hydra
 import pandas as pd
 
 import src.utils as utils
+from src.distill import add_teacher, report_distill
 from src.get_score import get_result
 from src.load_data import load_data
 from src.make_fold import make_fold
+from src.make_pipeline import make_pipeline
+from src.prediction_store import save_predictions
 from src.train_fold import train_fold
+from src.train_parallel import train_folds_parallel
 
 log = logging.getLogger(__name__)
 
@@ -25,33 +31,120 @@ def main(c):
 
     train, test, sub = load_data(c)
     train = make_fold(c, train)
-
+    if c.distill.enabled:
+        train = add_teacher(c, train)
+
+    cv_state = {"folds": {}}
+    if c.settings.resume and os.path.exists("cv_state.pth"):
+        cv_state = utils.load_checkpoint("cv_state.pth")
+        log.info(f"Resume: finished folds {sorted(cv_state['folds'])}")
+
+    folds = [0] if c.settings.debug else list(range(c.params.n_fold))
+    todo = [fold for fold in folds if fold not in cv_state["folds"]]
+    if c.settings.fold_workers > 1 and c.settings.fold_abort.enabled:
+        # Every fold is trained before the first result is seen.
+        raise Exception("fold_abort can not be used with fold_workers > 1.")
+    if c.settings.fold_workers > 1 and len(todo) > 0:
+        if utils.is_distributed():
+            raise Exception("fold_workers can not be used with DDP.")
+        results = dict(zip(todo, train_folds_parallel(c, train, todo)))
+
+    abort = None
+    if c.settings.fold_abort.enabled:
+        fa = c.settings.fold_abort
+        abort = utils.FoldAbort(
+            threshold=fa.threshold,
+            best_path=fa.best_path,
+            z=fa.z,
+            margin=fa.margin,
+            min_folds=fa.min_folds,
+        )
+
+    writer = utils.CheckpointWriter()
+    pipeline = None
     oof_df = pd.DataFrame()
     losses = utils.AverageMeter()
-    for fold in range(c.params.n_fold):
-        log.info(f"========== fold {fold} training ==========")
-        utils.seed_torch(c.params.seed + fold)
-
-        _oof_df, score, loss = train_fold(c, train, fold, device)
+    for fold in folds:
+        if fold in cv_state["folds"]:
+            _oof_df, score, loss = cv_state["folds"][fold]
+        else:
+            if c.settings.fold_workers > 1:
+                _oof_df, score, loss = results[fold]
+            else:
+                log.info(f"========== fold {fold} training ==========")
+                # Built once, its workers are shared by the remaining folds,
+                # unless the soft targets of distillation differ per fold.
+                if pipeline is None or not pipeline.serves(fold):
+                    pipeline = make_pipeline(c, train, device, fold)
+                utils.seed_torch(c.params.seed + fold)
+
+                _oof_df, score, loss = train_fold(
+                    c, train, fold, device, writer, pipeline
+                )
+
+            cv_state["folds"][fold] = (_oof_df, score, loss)
+            if c.settings.save_state and utils.is_main_process():
+                writer.save(cv_state, "cv_state.pth")
         oof_df = pd.concat([oof_df, _oof_df])
         losses.update(loss)
 
         log.info(f"========== fold {fold} result ==========")
-        get_result(c, _oof_df, fold, loss)
+        score = get_result(c, _oof_df, fold, loss)
 
-        if c.settings.debug:
+        if abort is not None and abort(score):
             break
 
-    oof_df.to_csv("oof_df.csv", index=False)
+    writer.close()
+    # Stops the persistent DataLoader workers.
+    del pipeline
+
+    if abort is not None and abort.aborted:
+        # Keep the partial result apart from the outputs of complete runs.
+        if utils.is_main_process():
+            oof_df.to_csv("oof_df_partial.csv", index=False)
+            with open("partial_result.json", "w") as f:
+                json.dump(
+                    {
+                        "aborted": True,
+                        "folds": folds[: len(abort.scores)],
+                        "scores": abort.scores,
+                        "score": abort.score,
+                        "reference": abort.reference,
+                    },
+                    f,
+                    indent=2,
+                )
+
+        log.info("Aborted.")
+
+        utils.teardown_mlflow(c, losses.avg, aborted=True)
+        utils.teardown_wandb(c, run, losses.avg, aborted=True)
+        utils.teardown_ddp()
+        return abort.score
+
+    if utils.is_main_process():
+        oof_df.to_csv("oof_df.csv", index=False)
+        save_predictions(c, oof_df)
 
     log.info(f"========== final result ==========")
     score = get_result(c, oof_df, c.params.n_fold, losses.avg)
+    if abort is not None and utils.is_main_process() and not c.settings.debug:
+        abort.update_best(score)
+    if c.distill.enabled and utils.is_main_process():
+        report_distill(c, oof_df, device)
 
     log.info("Done.")
 
     utils.teardown_mlflow(c, losses.avg)
     utils.teardown_wandb(c, run, losses.avg)
 
-    utils.send_result_to_slack(c, score, losses.avg)
+    if utils.is_main_process():
+        utils.send_result_to_slack(c, score, losses.avg)
+    utils.teardown_ddp()
+
+    # Objective of the optuna sweeper.
+    return score
+
+
 if __name__ == "__main__":
     main()
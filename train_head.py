@@ -0,0 +1,122 @@
+import logging
+import os
+
+import hydra
+import numpy as np
+import pandas as pd
+
+import src.utils as utils
+from src.get_score import get_result
+from src.load_data import load_data
+from src.make_embedding import make_embedding
+from src.make_ensemble import load_oof_matrix
+from src.make_fold import make_fold
+from src.make_head import make_head
+from src.predict import checkpoint_path, load_base_config
+from src.prediction_store import save_predictions
+
+log = logging.getLogger(__name__)
+
+
+@hydra.main(config_path="config", config_name="main")
+def main(c):
+    log.info("Started.")
+
+    utils.seed_torch(c.params.seed)
+    utils.debug_settings(c)
+    device = utils.gpu_settings(c)
+
+    utils.setup_mlflow(c)
+    run = utils.setup_wandb(c)
+
+    train, test, sub = load_data(c)
+    fold_weights = head_weights(c, train)
+    if fold_weights is None:
+        train = make_fold(c, train)
+        fold_weights = [c.head.weights] * c.params.n_fold
+    else:
+        c = load_base_config(c, base_dir(c))
+        # The folds the fold models of the base result have not been trained on.
+        train, _, folds = load_oof_matrix(c, train, [c.head.weights])
+        train["fold"] = folds
+
+    c.params.batch_size = c.head.batch_size
+    feature_cols = [col for col in test.columns if col != "Id"]
+    y = train["Pawpularity"].values.astype(np.float32)
+    folds = train["fold"].values
+
+    oof_df = pd.DataFrame()
+    test_preds = np.zeros((c.params.n_fold, len(test)), dtype=np.float32)
+    for fold in range(c.params.n_fold):
+        log.info(f"========== fold {fold} training ==========")
+        trn_idx = np.where(folds != fold)[0]
+        val_idx = np.where(folds == fold)[0]
+
+        weights = fold_weights[fold]
+        x_train = make_embedding(c, train, True, device, weights).astype(np.float32)
+        x_test = make_embedding(c, test, False, device, weights).astype(np.float32)
+        if c.head.use_features:
+            x_train = np.hstack(
+                [x_train, train[feature_cols].values.astype(np.float32)]
+            )
+            x_test = np.hstack([x_test, test[feature_cols].values.astype(np.float32)])
+
+        head = make_head(c).fit(x_train[trn_idx], y[trn_idx])
+
+        _oof_df = train.loc[val_idx].reset_index(drop=True)
+        _oof_df["preds"] = head.predict(x_train[val_idx])
+        oof_df = pd.concat([oof_df, _oof_df])
+        test_preds[fold] = head.predict(x_test)
+
+        log.info(f"========== fold {fold} result ==========")
+        get_result(c, _oof_df, fold)
+
+    oof_df.to_csv("oof_df.csv", index=False)
+    save_predictions(c, oof_df)
+
+    sub["Pawpularity"] = (
+        sub["Id"]
+        .map(pd.Series(test_preds.mean(axis=0), index=test["Id"].values))
+        .values
+    )
+    sub.to_csv("submission.csv", index=False)
+
+    log.info(f"========== final result ==========")
+    score = get_result(c, oof_df, c.params.n_fold)
+
+    log.info("Done.")
+
+    # Heads are not trained with a validation loss.
+    utils.teardown_mlflow(c, np.nan)
+    utils.teardown_wandb(c, run, np.nan)
+
+    utils.send_result_to_slack(c, score, np.nan)
+
+    return score
+
+
+def head_weights(c, train):
+    """Returns the checkpoint of each fold when head.weights is a base result,
+    None for pretrained weights or a single checkpoint.
+
+    A single checkpoint has been trained on most of the train rows, so the head
+    CV on its embeddings is optimistic. The fold models of a base result embed
+    the rows of their own fold, which they have not been trained on.
+    """
+    weights = c.head.weights
+    if weights == "pretrained":
+        return None
+    if os.path.isfile(weights):
+        log.warning(f"Head CV is optimistic, {weights} has been trained on its rows.")
+        return None
+
+    bc = load_base_config(c, base_dir(c))
+    return [checkpoint_path(bc, base_dir(c), fold) for fold in range(bc.params.n_fold)]
+
+
+def base_dir(c):
+    return os.path.join(c.settings.dirs.working, "..", "base_results", c.head.weights)
+
+
+if __name__ == "__main__":
+    main()
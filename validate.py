@@ -1,13 +1,15 @@
 import logging
-import os
+import time
 
 import hydra
+import numpy as np
 import pandas as pd
 from omegaconf import OmegaConf
 
 import wandb
 from src.get_score import get_result
 from src.load_data import load_data
+from src.make_ensemble import load_oof_matrix, make_ensemble
 
 log = logging.getLogger(__name__)
 
@@ -28,24 +30,37 @@ def main(c):
 
     train, test, sub = load_data(c)
 
-    for n, base in enumerate(c.validate.base_results):
-        oof = pd.read_csv(
-            os.path.join(
-                c.settings.dirs.working, "..", "base_results", base, "oof_df.csv"
-            )
-        )
-        oof = oof[["Id", "preds"]]
-        oof.columns = ["Id", f"preds{n}"]
-        train = pd.merge(train, oof, on="Id")
+    # Blending weights are fit on the folds the oof predictions are oof of.
+    base_results = list(c.validate.base_results)
+    train, x, folds = load_oof_matrix(c, train, base_results)
+    train["fold"] = folds
+    y = train["Pawpularity"].values.astype(np.float64)
+
+    results = {}
+    for method in c.validate.methods:
+        start = time.time()
+        preds, score, weights = make_ensemble(c, x, y, folds, method)
+        results[method] = (preds, score, weights)
+        log.info(f"{method}: CV score: {score:<.5f} time: {time.time() - start:.2f}s")
+
+    best = min(results, key=lambda method: results[method][1])
+    log.info(f"Best method: {best}")
 
-    cols = [f"preds{n}" for n in range(len(c.validate.base_results))]
-    train["preds"] = train[cols].values.mean(axis=1)
+    weights_df = pd.DataFrame(
+        {method: results[method][2] for method in results}, index=base_results
+    )
+    weights_df.index.name = "base"
+    used = weights_df[best] > 0
+    log.info(f"{best} weights:\n{weights_df.loc[used, best].to_string()}")
+    weights_df.to_csv("ensemble_weights.csv")
 
+    train["preds"] = results[best][0]
     score = get_result(c, train, c.params.n_fold)
 
     train.to_csv("validation_df.csv", index=False)
     if c.wandb.enabled:
         wandb.save("validation_df.csv")
+        wandb.save("ensemble_weights.csv")
 
     log.info("Done.")
 